@@ -0,0 +1,378 @@
+#!/usr/bin/python
+'''Benchmark the tools on a synthetic dataset.
+#
+# Generates --count jpg files of --width x --height with yolo_mark label
+# files (random filled rectangles on a smooth noise background, each
+# rectangle labelled), then times the per file work of each tool on them:
+#
+#   resizeimg.fixsize          clamp to --resize-width, on a copy
+#   makelst.processfile        header probe and label conversion
+#   mirrorxyz.flipimage        decode, flip and encode a mirror
+#   mirrorxyz.fliprect         flip a label file
+#   cleanupnames.copy_pair     copy a jpg/txt pair
+#   dvr.record_frame           synchronous DVR frame resize and encode
+#   dvr.record_frame_async     time the caller waits with an asynchronous DVR
+#   detectimg.prepare_image    decode and scale to the --net-width input
+#   detectimg.predict_images   batch collate and postprocess around a stub
+#                              model that returns canned detections (needs
+#                              mxnet for the NDArray batch, skipped without)
+#   postprocess.detections     threshold, NMS and top k of canned outputs
+#   imgcache.disk_hit          detectimg.prepare_image from a warm
+#                              imgcache disk store instead of decoding
+#
+# The results are written as JSON (stdout or --output) with the machine and
+# dataset details, so runs on the same machine can be compared, --compare
+# OLD.json prints the change of every stage against an earlier run.
+#
+#  python bench.py --count 200 --output before.json
+#  python bench.py --count 200 --compare before.json
+#'''
+import sys
+import os
+import io
+import json
+import time
+import shutil
+import argparse
+import platform
+import tempfile
+from collections import namedtuple
+from contextlib import redirect_stdout, redirect_stderr
+from functools import partial
+import numpy as np
+import cv2
+import yololabel
+import dirscan
+
+# written into a generated dataset, a directory without it is never changed
+MARKER = '.bench.json'
+STAGES = ['resizeimg.fixsize', 'makelst.processfile', 'mirrorxyz.flipimage',
+          'mirrorxyz.fliprect', 'cleanupnames.copy_pair', 'dvr.record_frame',
+          'dvr.record_frame_async', 'detectimg.prepare_image', 'detectimg.predict_images',
+          'postprocess.detections', 'imgcache.disk_hit']
+# nbbox, thresh, topk and nms of the postprocess.Filter of the detection stages
+BENCH_FILTER = (5, 0.5, 5, 0.45)
+
+def parse_args(argv=None):
+    '''Load args...'''
+    description = '''Time the tools on a synthetic dataset of jpg and yolo_mark files
+    and write the results as JSON'''
+    parser = argparse.ArgumentParser(description)
+    parser.add_argument('--count', dest='count', type=int, default=100,
+                        help='number of images in the dataset; default 100')
+    parser.add_argument('--width', dest='width', type=int, default=1920,
+                        help='width of the images; default 1920')
+    parser.add_argument('--height', dest='height', type=int, default=1080,
+                        help='height of the images; default 1080')
+    parser.add_argument('--labels', dest='labels', type=int, default=3,
+                        help='labelled rectangles per image; default 3')
+    parser.add_argument('--seed', dest='seed', type=int, default=0,
+                        help='random seed of the dataset; default 0')
+    parser.add_argument('--dataset', dest='dataset', type=str,
+                        help='''keep the dataset in this directory, and reuse it if it was
+                                generated with the same options; it must be empty or one
+                                bench.py made; default a temporary directory''')
+    parser.add_argument('--resize-width', dest='resize_width', type=int, default=640,
+                        help='width resizeimg.fixsize clamps to; default 640')
+    parser.add_argument('--net-width', dest='net_width', type=int, default=416,
+                        help='network input width for the detectimg stages; default 416')
+    parser.add_argument('--batch-size', dest='batch_size', type=int, default=8,
+                        help='batch size of the stub model; default 8')
+    parser.add_argument('--stages', dest='stages', type=str, default=','.join(STAGES),
+                        help='comma separated stages to run; default all')
+    parser.add_argument('--output', dest='output', type=str,
+                        help='write the JSON results to this file; default stdout')
+    parser.add_argument('--compare', dest='compare', type=str,
+                        help='print the change of each stage against this earlier JSON result')
+    return parser.parse_args(argv)
+
+def synthetic_image(rng, width, height, labels):
+    '''(image, rows) a width x height BGR image of labels random filled
+    rectangles on a smooth noise background drawn with the numpy Generator
+    rng, and the (labels, 5) yolo_mark rows of the rectangles'''
+    # smooth noise compresses like a photo, unlike per pixel noise
+    small = rng.integers(0, 256, (max(1, height // 16), max(1, width // 16), 3),
+                         dtype=np.uint8)
+    img = cv2.resize(small, (width, height), interpolation=cv2.INTER_LINEAR)
+    rows = []
+    for _ in range(labels):
+        w, h = rng.uniform(0.05, 0.4, 2)
+        x, y = rng.uniform(w / 2, 1 - w / 2), rng.uniform(h / 2, 1 - h / 2)
+        color = tuple(int(c) for c in rng.integers(0, 256, 3))
+        cv2.rectangle(img, (int((x - w / 2) * width), int((y - h / 2) * height)),
+                      (int((x + w / 2) * width), int((y + h / 2) * height)), color, -1)
+        rows.append([rng.integers(0, 10), x, y, w, h])
+    return img, np.array(rows, dtype=np.float32).reshape(-1, 5)
+
+def make_dataset(path, args):
+    '''write args.count synthetic args.width x args.height jpg files each
+    with a yolo_mark label file of args.labels rectangles into path, drawn
+    from args.seed.  returns the jpg paths'''
+    rng = np.random.default_rng(args.seed)
+    os.makedirs(path, exist_ok=True)
+    files = []
+    for i in range(args.count):
+        img, rows = synthetic_image(rng, args.width, args.height, args.labels)
+        jpg = os.path.join(path, 'img%05d.jpg' % i)
+        cv2.imwrite(jpg, img)
+        yololabel.save(dirscan.label_path(jpg), rows)
+        files.append(jpg)
+    return files
+
+def dataset_files(path, args):
+    '''the jpg files of the dataset in path, generated unless path holds
+    one bench.py made with the same options.  None if path has other files
+    in it, they are not ours to delete'''
+    params = {'count': args.count, 'width': args.width, 'height': args.height,
+              'labels': args.labels, 'seed': args.seed}
+    marker = os.path.join(path, MARKER)
+    if os.path.isdir(path) and os.listdir(path):
+        try:
+            with open(marker, 'r') as f:
+                made = json.load(f)
+        except (OSError, ValueError):
+            return None
+        files = sorted(e.path for e in dirscan.scan(path))
+        if made == params and len(files) == args.count:
+            return files
+        shutil.rmtree(path)
+    print("Generating", args.count, "images of", args.width, "x", args.height,
+          "in", path, file=sys.stderr)
+    files = make_dataset(path, args)
+    with open(marker, 'w') as f:
+        json.dump(params, f)
+    return files
+
+def timed(func, items):
+    '''call func on each item and return the timing statistics, anything
+    the tools print is thrown away'''
+    times = []
+    sink = io.StringIO()
+    with redirect_stdout(sink), redirect_stderr(sink):
+        for item in items:
+            t1 = time.perf_counter()
+            func(item)
+            times.append(time.perf_counter() - t1)
+    return stats(times)
+
+def stats(times):
+    '''count, total, mean and percentiles of a list of durations in seconds'''
+    times = np.array(times, dtype=np.float64)
+    if not len(times):
+        return {'count': 0}
+    total = float(times.sum())
+    return {'count': len(times), 'total_s': total,
+            'mean_ms': 1000 * total / len(times),
+            'p50_ms': 1000 * float(np.percentile(times, 50)),
+            'p95_ms': 1000 * float(np.percentile(times, 95)),
+            'items_per_s': len(times) / total if total > 0 else None}
+
+class StubModel:
+    '''stands in for a bound mxnet Module in detectimg.predict_images, the
+    forward pass does nothing and the outputs are canned detections, so
+    only detectimg's own work around the network is timed'''
+    def __init__(self, batch_size, width, boxes=100, seed=0):
+        import mxnet as mx
+        Desc = namedtuple('Desc', ['name', 'shape'])
+        self.data_shapes = [Desc('data', (batch_size, 3, width, width))]
+        self.outputs = [mx.nd.array(canned_outputs(batch_size, boxes, seed))]
+
+    def forward(self, batch):
+        '''nothing to do'''
+
+    def get_outputs(self):
+        '''the canned (batch_size, boxes, 6) output'''
+        return self.outputs
+
+def canned_outputs(batch_size, boxes=100, seed=0):
+    '''random (batch_size, boxes, 6) network outputs, some rows empty'''
+    rng = np.random.default_rng(seed)
+    prob = np.empty((batch_size, boxes, 6), dtype=np.float32)
+    prob[..., 0] = rng.integers(-1, 10, (batch_size, boxes))
+    prob[..., 1] = rng.random((batch_size, boxes))
+    xy = rng.random((batch_size, boxes, 2)) * 0.8
+    prob[..., 2:4] = xy
+    prob[..., 4:6] = xy + rng.random((batch_size, boxes, 2)) * 0.2
+    return prob
+
+# each stage is timed by a function of (files, work, args): the dataset jpg
+# files, an empty scratch directory and the parsed args
+
+def bench_fixsize(files, work, args):
+    '''resizeimg.fixsize of copies of the files'''
+    import resizeimg
+    copies = []
+    for f in files:
+        copies.append(os.path.join(work, os.path.basename(f)))
+        shutil.copyfile(f, copies[-1])
+    return timed(lambda f: resizeimg.fixsize(f, args.resize_width), copies)
+
+def bench_processfile(files, _work, _args):
+    '''makelst.processfile of the files'''
+    import makelst
+    return timed(makelst.processfile, files)
+
+def bench_flipimage(files, work, _args):
+    '''mirrorxyz.flipimage of the files into work'''
+    import mirrorxyz
+    return timed(lambda f: mirrorxyz.flipimage(
+        f, os.path.join(work, os.path.basename(f)), 1), files)
+
+def bench_fliprect(files, work, _args):
+    '''mirrorxyz.fliprect of the label files of the files into work'''
+    import mirrorxyz
+    return timed(lambda f: mirrorxyz.fliprect(
+        dirscan.label_path(f), os.path.join(work, os.path.basename(dirscan.label_path(f))),
+        1), files)
+
+def bench_copy_pair(files, work, _args):
+    '''cleanupnames.copy_pair of the files and their labels into work'''
+    import cleanupnames
+    tasks = [(f, os.path.join(work, 'bench%d.jpg' % i), dirscan.label_path(f),
+              os.path.join(work, 'bench%d.txt' % i)) for i, f in enumerate(files)]
+    return timed(cleanupnames.copy_pair, tasks)
+
+def bench_record_frame(files, work, _args, asynchronous=False):
+    '''DVR.record_frame_if_active of the decoded files into a clip in work,
+    with the time close takes to finish writing as close_s'''
+    import dvr
+    frames = [cv2.imread(f) for f in files]
+    sink = io.StringIO()
+    with redirect_stdout(sink), redirect_stderr(sink):
+        recorder = dvr.DVR(path=work, frame_rate=10,
+                           options=dvr.Options(asynchronous=asynchronous,
+                                               queue_size=len(frames) + 1))
+        recorder.activate_recording(duration=3600)
+    result = timed(recorder.record_frame_if_active, frames)
+    t1 = time.perf_counter()
+    with redirect_stdout(sink), redirect_stderr(sink):
+        recorder.close()
+    result['close_s'] = time.perf_counter() - t1
+    return result
+
+def bench_prepare_image(files, _work, args):
+    '''detectimg.prepare_image of the files'''
+    import detectimg
+    return timed(lambda f: detectimg.prepare_image(f, args.net_width), files)
+
+def bench_predict_images(files, _work, args):
+    '''detectimg.predict_images of batches of the prepared files on a
+    StubModel, skipped without a usable mxnet'''
+    import detectimg
+    flt = detectimg.postprocess.Filter(*BENCH_FILTER)
+    sink = io.StringIO()
+    with redirect_stdout(sink), redirect_stderr(sink):
+        images = [detectimg.prepare_image(f, args.net_width) for f in files]
+    batches = list(detectimg.batches(images, args.batch_size))
+    try:
+        model = StubModel(args.batch_size, args.net_width)
+        # a broken mxnet install (e.g. against a newer numpy) fails on first use
+        with redirect_stdout(sink), redirect_stderr(sink):
+            detectimg.predict_images(batches[0], model, flt)
+    except ImportError:
+        return {'skipped': 'mxnet is not installed'}
+    except Exception as e:  # pylint: disable=broad-except
+        return {'skipped': 'mxnet is not usable: %s: %s' %
+                           (type(e).__name__, (str(e).splitlines() or [''])[0])}
+    return timed(lambda b: detectimg.predict_images(b, model, flt), batches)
+
+def bench_detections(files, _work, args):
+    '''postprocess.detections of a batch of canned outputs per batch of files'''
+    import postprocess
+    flt = postprocess.Filter(*BENCH_FILTER)
+    outputs = [canned_outputs(args.batch_size, seed=i)
+               for i in range(max(1, len(files) // args.batch_size))]
+    return timed(lambda p: postprocess.detections(p, len(p), flt), outputs)
+
+def bench_disk_hit(files, work, args):
+    '''detectimg.prepare_image of the files from an imgcache disk store in
+    work warmed with them first'''
+    import detectimg
+    import imgcache
+    sink = io.StringIO()
+    with redirect_stdout(sink), redirect_stderr(sink):
+        warm = imgcache.ImageCache(0, work)
+        for f in files:
+            detectimg.prepare_image(f, args.net_width, warm)
+    cache = imgcache.ImageCache(0, work)
+    return timed(lambda f: detectimg.prepare_image(f, args.net_width, cache), files)
+
+STAGE_RUNNERS = {'resizeimg.fixsize': bench_fixsize,
+                 'makelst.processfile': bench_processfile,
+                 'mirrorxyz.flipimage': bench_flipimage,
+                 'mirrorxyz.fliprect': bench_fliprect,
+                 'cleanupnames.copy_pair': bench_copy_pair,
+                 'dvr.record_frame': bench_record_frame,
+                 'dvr.record_frame_async': partial(bench_record_frame, asynchronous=True),
+                 'detectimg.prepare_image': bench_prepare_image,
+                 'detectimg.predict_images': bench_predict_images,
+                 'postprocess.detections': bench_detections,
+                 'imgcache.disk_hit': bench_disk_hit}
+
+def run_stage(stage, files, work, args):
+    '''time one stage on the dataset files, work is an empty scratch directory'''
+    if stage not in STAGE_RUNNERS:
+        raise ValueError("unknown stage " + stage)
+    return STAGE_RUNNERS[stage](files, work, args)
+
+def compare(old, new):
+    '''print the change in mean time of each stage from old to new'''
+    print("%-28s %12s %12s %8s" % ('stage', 'old ms', 'new ms', 'change'), file=sys.stderr)
+    for stage, result in new['results'].items():
+        before = old.get('results', {}).get(stage, {})
+        if 'mean_ms' not in result or 'mean_ms' not in before:
+            continue
+        change = 100.0 * (result['mean_ms'] - before['mean_ms']) / before['mean_ms']
+        print("%-28s %12.3f %12.3f %+7.1f%%" %
+              (stage, before['mean_ms'], result['mean_ms'], change), file=sys.stderr)
+
+def main(argv=None):
+    '''generate the dataset, run the stages and write the results'''
+    args = parse_args(argv)
+    stages = [s for s in args.stages.split(',') if s]
+    for stage in stages:
+        if stage not in STAGES:
+            print(sys.argv[0], ": unknown stage", stage, file=sys.stderr)
+            sys.exit()
+
+    tmpdir = tempfile.mkdtemp(prefix='bench')
+    try:
+        datadir = args.dataset or os.path.join(tmpdir, 'dataset')
+        files = dataset_files(datadir, args)
+        if files is None:
+            print(sys.argv[0], ":", datadir, "is not empty and was not made by bench.py",
+                  file=sys.stderr)
+            sys.exit(1)
+
+        results = {}
+        for stage in stages:
+            work = os.path.join(tmpdir, stage)
+            os.makedirs(work)
+            print("Running", stage, file=sys.stderr)
+            results[stage] = run_stage(stage, files, work, args)
+            shutil.rmtree(work, ignore_errors=True)
+    finally:
+        shutil.rmtree(tmpdir, ignore_errors=True)
+
+    report = {'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+              'machine': {'node': platform.node(), 'machine': platform.machine(),
+                          'processor': platform.processor(), 'cpus': os.cpu_count(),
+                          'python': platform.python_version(), 'numpy': np.__version__,
+                          'opencv': cv2.__version__},
+              'dataset': {'count': args.count, 'width': args.width, 'height': args.height,
+                          'labels': args.labels, 'seed': args.seed},
+              'options': {'resize_width': args.resize_width, 'net_width': args.net_width,
+                          'batch_size': args.batch_size},
+              'results': results}
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(text + '\n')
+    else:
+        print(text)
+    if args.compare:
+        with open(args.compare, 'r') as f:
+            compare(json.load(f), report)
+
+if __name__ == '__main__':
+    main()
@@ -31,14 +31,46 @@
 #   src/232432-xX.jpg  -> dst/img2-xX.jpg
 #   src/232432-xX.txt  -> dst/img2-xX.txt
 #
+#  --link hard|reflink hardlinks (or reflinks, a copy on write clone on
+#  btrfs/xfs) the files instead of copying them, falling back to a copy
+#  when the filesystem can't.  A hardlinked dst file IS the src file, so
+#  anything rewriting it in place changes the source too (resizeimg.py
+#  writes a new file and renames it so it is safe).  --jobs copies that
+#  many files at a time, which helps a lot on network disks.
+#
+#  The old -> new names are kept in dst/.cleanupnames.json so a rerun only
+#  copies new or changed files, and a file keeps the same number (COUNTER)
+#  every run, new files are numbered after the highest number used so far.
+#
+#  --dedup report|skip hashes every source image (see dedup.py) and reports,
+#  or skips copying, images that are exact (same bytes) or near duplicates
+#  (perceptual hash within --hamming bits) of one already copied.  The first
+#  copy in name order wins and files copied by earlier runs always stay.
+#  The hashes are kept in dst/.dedupindex.npz so only new or changed files
+#  are hashed on a rerun, files gone from src are dropped from it.  A file
+#  that can't be read is skipped with a message.
+#
 '''
 import os
 import sys
+import json
 import shutil
-import fnmatch
 import argparse
+from functools import partial
+from concurrent.futures import ThreadPoolExecutor
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+import dedup
+import dirscan
 
-def parse_args():
+RENAME_MAP = '.cleanupnames.json'
+DEDUP_INDEX = '.dedupindex.npz'
+# linux ioctl to clone (reflink) a file, _IOW(0x94, 9, int)
+FICLONE = 0x40049409
+
+def parse_args(argv=None):
     '''Load args...'''
     description = '''Read all the JPG files (and associated yolo label txt files) in srcdir
     and copy them to dstdir using basename plus a counter.
@@ -73,38 +105,222 @@ def parse_args():
                         help='target directory to copy renamed files into')
     parser.add_argument('--basename', dest='basename', required=True, type=str,
                         help='basename to use to form new file names')
+    parser.add_argument('--link', dest='link', choices=['hard', 'reflink'],
+                        help='''hardlink or reflink files instead of copying them, falls back
+                                to copying if the filesystem can't''')
+    parser.add_argument('--jobs', dest='jobs', type=int, default=8,
+                        help='number of files to copy at the same time; default 8')
+    parser.add_argument('--dedup', dest='dedup', choices=['report', 'skip'],
+                        help='report, or skip copying, duplicate and near duplicate images')
+    parser.add_argument('--hamming', dest='hamming', type=int, default=4,
+                        help='''max perceptual hash bits that differ for --dedup to call
+                                images near duplicates, 0 only finds exact copies; default 4''')
+    parser.add_argument('--recursive', dest='recursive', action='store_true',
+                        help='also copy files from subdirectories of srcdir (into dstdir)')
 
-    args = parser.parse_args()
+    args = parser.parse_args(argv)
     return args
 
-ARGS = parse_args()
-
-if not os.path.exists(ARGS.srcdir):
-    print(sys.argv[0], ARGS.srcdir, "(srcdir) does not exist", file=sys.stderr)
-    sys.exit()
-
-if not os.path.exists(ARGS.dstdir):
-    print(sys.argv[0], ARGS.dstdir, "(dstdir) does not exist", file=sys.stderr)
-    sys.exit()
-
-#loop through one file at a time
-COUNTER = 0
-for file in fnmatch.filter(os.listdir(ARGS.srcdir), "*.jpg"):
-    # form the full path to the source jpg file
-    srcjpg = os.path.join(ARGS.srcdir, file)
-    basename = ARGS.basename
-    if file[-7:] in ["-xX.jpg", "-yY.jpg", "-zZ.jpg"]:
-        # preserve extentions by mirrorxzy.py if the file has it
-        basename += file[-7:-4]
-
-    txtfile = srcjpg[:-4] + ".txt"
-    dstjpg = os.path.join(ARGS.dstdir, basename+str(COUNTER) + ".jpg")
-    dsttxt = os.path.join(ARGS.dstdir, basename+str(COUNTER) + ".txt")
-    shutil.copyfile(srcjpg, dstjpg)
-    print("Copy:", srcjpg, "to", dstjpg, file=sys.stderr)
-    if os.path.exists(txtfile):
-        shutil.copyfile(txtfile, dsttxt)
-        print("Copy:", txtfile, "to", dsttxt, file=sys.stderr)
-    COUNTER += 1
-
-print(sys.argv[0], ": processed", COUNTER, "jpg files", file=sys.stderr)
+def reflink(src, dst):
+    '''clone src to dst sharing its data blocks (copy on write), raises
+    OSError if the platform or filesystem can't'''
+    if fcntl is None:
+        raise OSError("reflink not supported")
+    with open(src, 'rb') as fsrc, open(dst, 'wb') as fdst:
+        fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+
+def place(src, dst, link=None):
+    '''copy (or link) src to dst, overwriting dst.  returns how it was done
+    'hardlink', 'reflink' or 'copy' '''
+    if os.path.lexists(dst):
+        os.remove(dst)
+    if link == 'hard':
+        try:
+            os.link(src, dst)
+            return 'hardlink'
+        except OSError:
+            pass
+    elif link == 'reflink':
+        try:
+            reflink(src, dst)
+            return 'reflink'
+        except OSError:
+            if os.path.exists(dst):
+                os.remove(dst)
+    shutil.copyfile(src, dst)
+    return 'copy'
+
+def file_state(path):
+    '''[size, mtime_ns] of path, None if it does not exist'''
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return [st.st_size, st.st_mtime_ns]
+
+def load_rename_map(dstdir):
+    '''the {src jpg name: {counter, basename, jpg, txt}} map of earlier runs'''
+    try:
+        with open(os.path.join(dstdir, RENAME_MAP), 'r') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+def save_rename_map(dstdir, renames):
+    '''write the rename map, atomically so a killed run can't corrupt it'''
+    fname = os.path.join(dstdir, RENAME_MAP)
+    with open(fname + '.tmp', 'w') as f:
+        json.dump(renames, f, sort_keys=True)
+    os.replace(fname + '.tmp', fname)
+
+def copy_pair(task, link=None):
+    '''copy the (srcjpg, dstjpg, txtfile, dsttxt) of a task, the txt only if
+    it exists. returns the messages to print, a file that can't be copied is
+    reported rather than stopping the run'''
+    srcjpg, dstjpg, txtfile, dsttxt = task
+    try:
+        how = place(srcjpg, dstjpg, link)
+        messages = ["%s: %s to %s" % (how.capitalize(), srcjpg, dstjpg)]
+        if os.path.exists(txtfile):
+            how = place(txtfile, dsttxt, link)
+            messages.append("%s: %s to %s" % (how.capitalize(), txtfile, dsttxt))
+    except OSError as ex:
+        return ["Failed: %s to %s: %s" % (srcjpg, dstjpg, ex)]
+    return messages
+
+def hash_file(srcdir, item):
+    '''(file, state, digest, phash) of a (file, [size, mtime_ns]) source
+    image, None if it can't be read (or is gone)'''
+    file, state = item
+    try:
+        digest, phash = dedup.hash_image(os.path.join(srcdir, file))
+    except OSError as ex:
+        print(sys.argv[0], ": skipping", file + ":", ex.strerror, file=sys.stderr)
+        return None
+    return file, state, digest, phash
+
+def index_files(args, files):
+    '''{file: (digest, phash)} of the files, only the new or changed ones
+    are hashed, the index in dstdir is updated and forgets files that are
+    gone'''
+    path = os.path.join(args.dstdir, DEDUP_INDEX)
+    hashes = dedup.DedupIndex.load(path, args.hamming)
+    states = {file: file_state(os.path.join(args.srcdir, file)) for file in files}
+    # a file that is gone is skipped when it is copied
+    states = {file: state for file, state in states.items() if state is not None}
+    hashes.retain(states)
+    todo = [(file, state) for file, state in states.items()
+            if hashes.lookup(file, *state) is None]
+    print(sys.argv[0], ": hashing", len(todo), "new or changed jpg files", file=sys.stderr)
+    with ThreadPoolExecutor(max_workers=max(1, args.jobs)) as pool:
+        for hashed in pool.map(partial(hash_file, args.srcdir), todo):
+            if hashed is not None:
+                file, state, digest, phash = hashed
+                hashes.add(file, state[0], state[1], digest, phash)
+    hashes.save(path)
+    found = {}
+    for file, state in states.items():
+        hashed = hashes.lookup(file, *state)
+        if hashed is not None:
+            found[file] = hashed
+    return found
+
+def find_duplicates(args, files, renames):
+    '''return {file: (original, distance)} for the files that are duplicates
+    of a file copied before them, distance is None for an exact copy (the
+    same bytes).  Files already in renames are kept'''
+    found = index_files(args, files)
+    # compare against the files being kept, files copied by an earlier run
+    # first and then the new ones in name order
+    kept = dedup.DedupIndex(args.hamming)
+    for file in files:
+        if file in renames and file in found:
+            kept.add(file, 0, 0, *found[file])
+    duplicates = {}
+    for file in files:
+        if file in renames or file not in found:
+            continue
+        digest, phash = found[file]
+        match = kept.find(digest, phash, exclude=file)
+        if match is None:
+            kept.add(file, 0, 0, digest, phash)
+        elif kept.lookup(match[0], 0, 0)[0] == digest:
+            duplicates[file] = (match[0], None)
+        else:
+            duplicates[file] = match
+    return duplicates
+
+def report_duplicate(file, original, distance):
+    '''print that file is a copy (distance None) or near duplicate of original'''
+    if distance is None:
+        print("Duplicate: %s is a copy of %s" % (file, original), file=sys.stderr)
+    else:
+        print("Near duplicate: %s of %s (%d bits differ)" % (file, original, distance),
+              file=sys.stderr)
+
+def main(argv=None):
+    '''copy the files from srcdir to dstdir as the command line (or argv) specifies'''
+    args = parse_args(argv)
+
+    if not os.path.exists(args.srcdir):
+        print(sys.argv[0], args.srcdir, "(srcdir) does not exist", file=sys.stderr)
+        sys.exit()
+
+    if not os.path.exists(args.dstdir):
+        print(sys.argv[0], args.dstdir, "(dstdir) does not exist", file=sys.stderr)
+        sys.exit()
+
+    renames = load_rename_map(args.dstdir)
+    # new files are numbered after the highest number any run has used
+    counter = max([entry['counter'] + 1 for entry in renames.values()] or [0])
+
+    # work out the destination of one file at a time
+    tasks = []
+    files = sorted(e.relpath for e in dirscan.scan(args.srcdir, recursive=args.recursive))
+    duplicates = find_duplicates(args, files, renames) if args.dedup else {}
+    skipped = 0
+    for file in files:
+        if file in duplicates:
+            report_duplicate(file, *duplicates[file])
+            if args.dedup == 'skip':
+                skipped += 1
+                continue
+        # form the full path to the source jpg file
+        srcjpg = os.path.join(args.srcdir, file)
+        txtfile = dirscan.label_path(srcjpg)
+        state = {'jpg': file_state(srcjpg), 'txt': file_state(txtfile)}
+        if state['jpg'] is None:
+            print(sys.argv[0], ": skipping", file + ": it no longer exists", file=sys.stderr)
+            skipped += 1
+            continue
+        entry = renames.get(file)
+        if entry is None or entry['basename'] != args.basename:
+            entry = {'counter': counter, 'basename': args.basename}
+            counter += 1
+        basename = args.basename
+        if dirscan.stem(file)[-3:] in ["-xX", "-yY", "-zZ"]:
+            # preserve extentions by mirrorxzy.py if the file has it
+            basename += dirscan.stem(file)[-3:]
+
+        dstjpg = os.path.join(args.dstdir, basename+str(entry['counter']) + ".jpg")
+        dsttxt = os.path.join(args.dstdir, basename+str(entry['counter']) + ".txt")
+        if (entry.get('jpg') == state['jpg'] and entry.get('txt') == state['txt']
+                and os.path.exists(dstjpg)):
+            # copied by an earlier run and not changed since
+            continue
+        entry.update(state)
+        renames[file] = entry
+        tasks.append((srcjpg, dstjpg, txtfile, dsttxt))
+
+    with ThreadPoolExecutor(max_workers=max(1, args.jobs)) as pool:
+        for messages in pool.map(partial(copy_pair, link=args.link), tasks):
+            for message in messages:
+                print(message, file=sys.stderr)
+
+    save_rename_map(args.dstdir, renames)
+    print(sys.argv[0], ": processed", len(tasks), "jpg files,",
+          len(files) - len(tasks) - skipped, "unchanged,", len(duplicates), "duplicates",
+          file=sys.stderr)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,179 @@
+'''Content hash index for finding duplicate and near duplicate images.
+#
+# Every image gets two hashes:
+#   digest  a blake2b hash of the file bytes, equal only for identical files
+#   phash   a 64 bit difference hash (dHash) of a tiny grayscale copy of the
+#           image, images that look the same (resized, recompressed, lightly
+#           edited) end up a small Hamming distance apart
+#
+# The index is saved as one compressed numpy .npz file of fixed width
+# arrays (name, size, mtime, digest, phash) so it loads quickly and stays
+# small with millions of images.  It is incremental: files whose size and
+# mtime have not changed keep their hashes without being read again.
+#
+# Near duplicate lookups use multi-index hashing: the 64 bits are split into
+# max_distance + 1 chunks and each chunk value is a dict key.  Two hashes
+# within max_distance bits must agree exactly on at least one chunk
+# (pigeonhole), so only the entries sharing a chunk are compared.
+#
+#  index = DedupIndex.load('dst/.dedupindex.npz', max_distance=4)
+#  digest, phash = hash_image('src/foo.jpg')
+#  dup = index.find(digest, phash)        # (name, distance) or None
+#  index.add('foo.jpg', size, mtime, digest, phash)
+#  index.save('dst/.dedupindex.npz')
+#'''
+import os
+import hashlib
+import numpy as np
+import cv2
+
+DIGEST_SIZE = 16
+PHASH_BITS = 64
+
+
+def file_digest(filename):
+    '''blake2b digest of the bytes of filename'''
+    h = hashlib.blake2b(digest_size=DIGEST_SIZE)
+    with open(filename, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            h.update(block)
+    return h.digest()
+
+
+def dhash(img):
+    '''64 bit difference hash of a BGR or grayscale image: shrink to 9x8
+    and set a bit for each pixel brighter than its right hand neighbour'''
+    if img.ndim == 3:
+        img = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
+    small = cv2.resize(img, (9, 8), interpolation=cv2.INTER_AREA)
+    bits = (small[:, 1:] > small[:, :-1]).ravel()
+    return int.from_bytes(np.packbits(bits).tobytes(), 'big')
+
+
+def hash_image(filename):
+    '''(digest, phash) of the image file, phash is None if it can't be
+    decoded. The image is decoded at 1/8 scale, plenty for a 9x8 hash'''
+    digest = file_digest(filename)
+    img = cv2.imread(filename, cv2.IMREAD_REDUCED_GRAYSCALE_8)
+    if img is None:
+        return digest, None
+    return digest, dhash(img)
+
+
+def hamming(a, b):
+    '''number of bits that differ between two hashes'''
+    return bin(a ^ b).count('1')
+
+
+class DedupIndex:
+    '''Exact and near duplicate lookups over a set of named image hashes'''
+    def __init__(self, max_distance=4):
+        self.max_distance = max_distance
+        self.names = []
+        self.sizes = []
+        self.mtimes = []
+        self.digests = []
+        self.phashes = []
+        self._by_name = {}
+        self._by_digest = {}
+        # chunk k of the phash covers bits _bounds[k] .. _bounds[k + 1]
+        chunks = max(1, max_distance + 1)
+        self._bounds = [PHASH_BITS * k // chunks for k in range(chunks + 1)]
+        self._tables = [{} for _ in range(chunks)]
+
+    @classmethod
+    def load(cls, filename, max_distance=4):
+        '''load an index saved by save(), an empty index if there is none'''
+        index = cls(max_distance)
+        if not os.path.exists(filename):
+            return index
+        with np.load(filename) as data:
+            for name, size, mtime, digest, phash, valid in zip(
+                    data['names'].tolist(), data['sizes'].tolist(), data['mtimes'].tolist(),
+                    data['digests'].tolist(), data['phashes'].tolist(),
+                    data['valid'].tolist()):
+                index.add(name, size, mtime, bytes(digest), phash if valid else None)
+        return index
+
+    def save(self, filename):
+        '''write the index as a compressed .npz, atomically'''
+        live = [i for i, name in enumerate(self.names) if name is not None]
+        digests = np.frombuffer(b''.join(self.digests[i] for i in live), dtype=np.uint8)
+        tmpname = filename + '.tmp.npz'
+        np.savez_compressed(tmpname,
+                            names=np.array([self.names[i] for i in live], dtype=np.str_),
+                            sizes=np.array([self.sizes[i] for i in live], dtype=np.int64),
+                            mtimes=np.array([self.mtimes[i] for i in live], dtype=np.int64),
+                            digests=digests.reshape(len(live), DIGEST_SIZE),
+                            phashes=np.array([self.phashes[i] or 0 for i in live],
+                                             dtype=np.uint64),
+                            valid=np.array([self.phashes[i] is not None for i in live],
+                                           dtype=bool))
+        os.replace(tmpname, filename)
+
+    def __len__(self):
+        return len(self._by_name)
+
+    def __chunks(self, phash):
+        '''the value of each chunk of phash'''
+        return [(phash >> lo) & ((1 << (hi - lo)) - 1)
+                for lo, hi in zip(self._bounds[:-1], self._bounds[1:])]
+
+    def lookup(self, name, size, mtime):
+        '''the (digest, phash) recorded for name if its size and mtime still
+        match, otherwise None and it has to be hashed again'''
+        i = self._by_name.get(name)
+        if i is None or self.sizes[i] != size or self.mtimes[i] != mtime:
+            return None
+        return self.digests[i], self.phashes[i]
+
+    def add(self, name, size, mtime, digest, phash):
+        '''add (or replace) the hashes of name'''
+        if name in self._by_name:
+            self.remove(name)
+        i = len(self.names)
+        self.names.append(name)
+        self.sizes.append(size)
+        self.mtimes.append(mtime)
+        self.digests.append(digest)
+        self.phashes.append(phash)
+        self._by_name[name] = i
+        self._by_digest.setdefault(digest, []).append(i)
+        if phash is not None:
+            for table, chunk in zip(self._tables, self.__chunks(phash)):
+                table.setdefault(chunk, []).append(i)
+
+    def remove(self, name):
+        '''forget name, its slot is left empty so other entries don't move'''
+        i = self._by_name.pop(name)
+        self._by_digest[self.digests[i]].remove(i)
+        if self.phashes[i] is not None:
+            for table, chunk in zip(self._tables, self.__chunks(self.phashes[i])):
+                table[chunk].remove(i)
+        self.names[i] = None
+
+    def retain(self, names):
+        '''forget every name that is not in names (a set or dict)'''
+        for name in [n for n in self._by_name if n not in names]:
+            self.remove(name)
+
+    def find(self, digest, phash, exclude=None):
+        '''return (name, distance) of an indexed image that is a duplicate,
+        distance 0 with an identical digest, or None.  exclude is a name to
+        ignore, usually the one being checked'''
+        for i in self._by_digest.get(digest, []):
+            if self.names[i] is not None and self.names[i] != exclude:
+                return self.names[i], 0
+        if phash is None or self.max_distance <= 0:
+            return None
+        best = None
+        seen = set()
+        for table, chunk in zip(self._tables, self.__chunks(phash)):
+            for i in table.get(chunk, []):
+                if i in seen or self.names[i] is None or self.names[i] == exclude:
+                    continue
+                seen.add(i)
+                distance = hamming(phash, self.phashes[i])
+                if distance <= self.max_distance and (best is None or distance < best[1]):
+                    best = (self.names[i], distance)
+        return best
@@ -2,7 +2,16 @@
 '''
 usage: detectimg.py [-h] --prefix PREFIX [--synset SYNSET] [--thresh THRESH]
                   [--pause PAUSE] [--nbbox NBBOX] [--width WIDTH]
-                  [--imagedir IMAGEDIR] [--noplt]
+                  [--imagedir IMAGEDIR] [--noplt] [--record RECORD]
+                  [--batch-size BATCH_SIZE] [--workers WORKERS]
+                  [--queue-depth QUEUE_DEPTH] [--topk TOPK] [--nms NMS]
+                  [--tile] [--tile-overlap TILE_OVERLAP] [--video SOURCE]
+                  [--stride STRIDE] [--no-skip] [--pretrigger PRETRIGGER]
+                  [--metrics FILE] [--metrics-port PORT]
+                  [--metrics-log SECONDS] [--cache-mb CACHE_MB]
+                  [--cache-dir DIR] [--cache-dir-mb CACHE_DIR_MB]
+                  [--pack PREFIX] [--recursive] [--serve SOCKET]
+                  [--server SOCKET]
                   ...
 
 Draw bounding boxes of classes detected in model in the images found in
@@ -27,20 +36,93 @@ optional arguments:
                        tst.img
   --noplt              text only, do not popup plt canvass and draw bounding
                        boxes
+  --record RECORD      record detection to file specified, boxes are drawn
+                       without matplotlib so this also works with --noplt
+  --batch-size BATCH_SIZE
+                       number of images to run through the network in a single
+                       forward pass; default 1
+  --workers WORKERS    number of threads decoding and preprocessing images
+                       ahead of inference; default number of cpus
+  --queue-depth QUEUE_DEPTH
+                       max number of preprocessed images waiting for
+                       inference; default 4 x batch-size
+  --topk TOPK          max number of boxes kept per class of an image; default
+                       0, no limit
+  --nms NMS            suppress boxes overlapping a better box of the same
+                       class by more than this IoU; default 0, off
+  --tile               run detection on overlapping width x width tiles of
+                       the full resolution image instead of scaling it down
+  --tile-overlap TILE_OVERLAP
+                       fraction of a tile shared with its neighbours;
+                       default 0.2
+  --video SOURCE       run detection on the frames of a video file or capture
+                       device number instead of jpg files, with --record a
+                       clip is recorded whenever something >= thresh is seen
+  --stride STRIDE      with --video only decode every STRIDE'th frame;
+                       default 1
+  --no-skip            with --video run every frame instead of skipping
+                       frames to keep up with real time
+  --pretrigger PRETRIGGER
+                       with --video and --record, seconds of frames from
+                       before a detection to start the clip with; default 2
+  --metrics FILE       write per stage timings, queue depths and dropped
+                       frames to FILE in the Prometheus text format
+  --metrics-port PORT  serve the metrics at http://127.0.0.1:PORT/metrics
+  --metrics-log SECONDS
+                       print the metrics as a JSON line to stderr every
+                       SECONDS (and rewrite --metrics that often)
+  --cache-mb CACHE_MB  memory for keeping decoded and scaled images for
+                       reuse; default 256 with --serve, otherwise 0
+  --cache-dir DIR      also keep the decoded and scaled images in DIR so
+                       later runs at the same width skip decoding them
+  --cache-dir-mb CACHE_DIR_MB
+                       trim --cache-dir to this size, oldest first; default
+                       0, no limit
+  --pack PREFIX        run detection on the images of the packset PREFIX
+                       (see packset.py) instead of imagedir, the arguments
+                       are record names to pick from it
+  --recursive          also run detection on jpg files in subdirectories of
+                       imagedir
+  --serve SOCKET       load the model once and serve detection requests on
+                       the unix socket SOCKET until interrupted
+  --server SOCKET      send the images to the detection server on SOCKET,
+                       loading the model here if there is none
+
+The functions can be imported and used from other scripts, mxnet, gluoncv
+and matplotlib are only imported once a model is loaded or a plot drawn:
+
+  import detectimg
+  model, classnames = detectimg.init('model/yolo', 'synset.txt', batch_size=8)
+  labels, scores, bbox = detectimg.predict('img0.jpg', model, 5, 416)
+  flt = postprocess.Filter(thresh=0.5, nms=0.45)
+  labels, scores, bbox = detectimg.predict('img0.jpg', model, 5, 416, flt)
+
+detectimg.main(argv) runs the command line with a list of arguments.
 '''
+import sys
 import time
-import fnmatch
 import os
+import base64
 import argparse
-from collections import namedtuple
+import threading
+from collections import namedtuple, deque
+from functools import partial
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
 import numpy as np
 import cv2
-from matplotlib import pyplot as plt
-from gluoncv import utils
-import mxnet as mx
+import detectserver
+import dirscan
 import dvr
+import imgcache
+import imgio
+import metrics
+import packset
+import postprocess
+import tiling
+import videostream
 
-def parse_args():
+def parse_args(argv=None):
     '''Load args...'''
     description = '''Draw bounding boxes of classes detected in model in the
     images found in imagedir unless image(s) are specified on the command line.'''
@@ -63,21 +145,85 @@ def parse_args():
     parser.add_argument('--noplt', dest='noplt', action='store_true',
                         help='text only, do not popup plt canvass and draw bounding boxes')
     parser.add_argument ('--record', dest='record', type=str,
-                         help='record detection to file specified, does not work with --noplt')
+                         help='''record detection to file specified, boxes are drawn
+                                 without matplotlib so this also works with --noplt''')
+    parser.add_argument('--batch-size', dest='batch_size', type=int, default=1,
+                        help='''number of images to run through the network in a single
+                                forward pass; default 1''')
+    parser.add_argument('--workers', dest='workers', type=int, default=os.cpu_count(),
+                        help='''number of threads decoding and preprocessing images
+                                ahead of inference; default number of cpus''')
+    parser.add_argument('--queue-depth', dest='queue_depth', type=int, default=0,
+                        help='''max number of preprocessed images waiting for inference;
+                                default 4 x batch-size''')
+    parser.add_argument('--topk', dest='topk', type=int, default=0,
+                        help='max number of boxes kept per class of an image; default 0, no limit')
+    parser.add_argument('--nms', dest='nms', type=float, default=0.0,
+                        help='''suppress boxes overlapping a better box of the same class by more
+                                than this IoU; default 0, off''')
+    parser.add_argument('--tile', dest='tile', action='store_true',
+                        help='''run detection on overlapping width x width tiles of the full
+                                resolution image instead of scaling it down''')
+    parser.add_argument('--tile-overlap', dest='tile_overlap', type=float, default=0.2,
+                        help='fraction of a tile shared with its neighbours; default 0.2')
+    parser.add_argument('--video', dest='video', type=str, metavar='SOURCE',
+                        help='''run detection on the frames of a video file or capture device
+                                number instead of jpg files, with --record a clip is
+                                recorded whenever something >= thresh is seen''')
+    parser.add_argument('--stride', dest='stride', type=int, default=1,
+                        help="with --video only decode every STRIDE'th frame; default 1")
+    parser.add_argument('--no-skip', dest='no_skip', action='store_true',
+                        help='''with --video run every frame instead of skipping frames to
+                                keep up with real time''')
+    parser.add_argument('--pretrigger', dest='pretrigger', type=float, default=2.0,
+                        help='''with --video and --record, seconds of frames from before a
+                                detection to start the clip with; default 2''')
+    parser.add_argument('--metrics', dest='metrics', type=str, metavar='FILE',
+                        help='''write per stage timings, queue depths and dropped frames to
+                                FILE in the Prometheus text format''')
+    parser.add_argument('--metrics-port', dest='metrics_port', type=int, metavar='PORT',
+                        help='serve the metrics at http://127.0.0.1:PORT/metrics')
+    parser.add_argument('--metrics-log', dest='metrics_log', type=float, default=0,
+                        metavar='SECONDS',
+                        help='''print the metrics as a JSON line to stderr every SECONDS (and
+                                rewrite --metrics that often)''')
+    parser.add_argument('--cache-mb', dest='cache_mb', type=int,
+                        help='''memory for keeping decoded and scaled images for reuse; default
+                                256 with --serve, otherwise 0''')
+    parser.add_argument('--cache-dir', dest='cache_dir', type=str, metavar='DIR',
+                        help='''also keep the decoded and scaled images in DIR so later runs at
+                                the same width skip decoding them''')
+    parser.add_argument('--cache-dir-mb', dest='cache_dir_mb', type=int, default=0,
+                        help='trim --cache-dir to this size, oldest first; default 0, no limit')
+    parser.add_argument('--pack', dest='pack', type=str, metavar='PREFIX',
+                        help='''run detection on the images of the packset PREFIX (see
+                                packset.py) instead of imagedir, the arguments are record
+                                names to pick from it''')
+    parser.add_argument('--recursive', dest='recursive', action='store_true',
+                        help='also run detection on jpg files in subdirectories of imagedir')
+    parser.add_argument('--serve', dest='serve', type=str, metavar='SOCKET',
+                        help='''load the model once and serve detection requests on the unix
+                                socket SOCKET until interrupted''')
+    parser.add_argument('--server', dest='server', type=str, metavar='SOCKET',
+                        help='''send the images to the detection server on SOCKET, loading the
+                                model here if there is none''')
     parser.add_argument('args', nargs=argparse.REMAINDER,
                         help='optional space separated list of files to load from command line')
-    args = parser.parse_args()
+    args = parser.parse_args(argv)
     return args
 
-def loadModel(modelname):
-    '''load and bind the model specified by the prefix passed in'''
+def loadModel(modelname, batch_size=1, width=416):
+    '''load and bind the model specified by the prefix passed in, the data
+    shape is bound to (batch_size, 3, width, width) so every forward pass
+    runs batch_size images'''
+    import mxnet as mx
     t1 = time.time()
     sym, arg_params, aux_params = mx.model.load_checkpoint(modelname, 0)
     arg_params['prob_label'] = mx.nd.array([0])
     mod = mx.mod.Module(symbol=sym)
-    mod.bind(for_training=False, data_shapes=[('data', (1, 3, 416, 416))])
+    mod.bind(for_training=False, data_shapes=[('data', (batch_size, 3, width, width))])
     mod.set_params(arg_params, aux_params)
-    print("Loaded in %2.2f milliseconds" % (time.time()-t1)*1000)
+    print("Loaded in %2.2f milliseconds" % ((time.time() - t1) * 1000))
     return mod
 
 def loadCategories(filename):
@@ -91,88 +237,625 @@ def loadCategories(filename):
     return synsets
 
 
+def to_input(img):
+    '''convert a BGR image already scaled to the network input size into
+    the (3, H, W) RGB layout the network takes'''
+    img = cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
+    img = np.swapaxes(img, 0, 2)
+    img = np.swapaxes(img, 1, 2)
+    return img
+
+def decoded(img):
+    '''img, raising ValueError if the image could not be decoded (is None)'''
+    if img is None:
+        raise ValueError("not a readable image")
+    return img
+
+def load_input(filename, width):
+    '''decode filename scaled to width x width in the network input layout'''
+    with metrics.timer('decode'):
+        img = decoded(imgio.imread_scaled(filename, (width, width)))
+    with metrics.timer('preprocess'):
+        return to_input(img)
+
+def prepare_image(filename, width, cache=None):
+    '''load the specified image, and adjust it for input into the network.
+    the image will be scaled to width x width and returned as a (3, H, W)
+    numpy array ready to be collated into a batch.  with an
+    imgcache.ImageCache it is only decoded if it isn't in the cache'''
+    if cache is None:
+        img = load_input(filename, width)
+    else:
+        img = cache.load(filename, width, load_input)
+    return img
+
+def prepare_file(filename, width, cache=None, keep_frame=False):
+    '''prepare_image returning (image, frame), with keep_frame the frame is
+    the full size decoded image for drawing the detections on, decoded
+    once and scaled for the network input too when that isn't cached.
+    without keep_frame the frame is None'''
+    if not keep_frame:
+        return prepare_image(filename, width, cache), None
+    with metrics.timer('decode'):
+        frame = decoded(cv2.imread(filename))
+    if cache is None:
+        img = prepare_frame(frame, width)
+    else:
+        # a miss is scaled from the frame, there is nothing left to decode
+        img = cache.load(filename, width, lambda _, w: prepare_frame(frame, w))
+    return img, frame
+
+def prepare_record(name, width, dataset, keep_frame=False):
+    '''prepare_file for the record name of a packset.PackedDataset, decoded
+    straight from the memory mapped pack'''
+    i = dataset.position(name)
+    frame = None
+    if keep_frame:
+        with metrics.timer('decode'):
+            frame = decoded(dataset.image(i))
+        img = prepare_frame(frame, width)
+    else:
+        with metrics.timer('decode'):
+            img = decoded(dataset.image(i, (width, width)))
+        with metrics.timer('preprocess'):
+            img = to_input(img)
+    return img, frame
+
+def prepare_bytes(jpg, width):
+    '''prepare_image for an image that is already in memory as encoded bytes'''
+    img = cv2.imdecode(np.frombuffer(jpg, dtype=np.uint8), cv2.IMREAD_COLOR)
+    return to_input(cv2.resize(img, (width, width)))
+
+def prepare_tiles(filename, width, overlap=0.2, dataset=None):
+    '''load the specified image (a record name of the packset.PackedDataset
+    dataset if given) at full resolution and cut it into overlapping width x
+    width tiles, returns (tiled, frame), tiled is (batch, origins, shape) the
+    (tiles, 3, width, width) batch, the corner of each tile and the shape of
+    the image, frame is the decoded image'''
+    with metrics.timer('decode'):
+        if dataset is None:
+            img = cv2.imread(filename)
+        else:
+            img = dataset.image(dataset.position(filename))
+    decoded(img)
+    origins = tiling.tile_origins(img.shape, width, overlap)
+    with metrics.timer('preprocess'):
+        return (tiling.tile_batch(img, origins, width), origins, img.shape), img
+
+def print_prepared(filename, shape, tiles=None):
+    '''the line about an image ready for the network, printed as the images
+    are taken in order off the prefetch queue (not on the worker threads
+    where it would interleave with other output)'''
+    if tiles is None:
+        print("\nFile: ", filename, "Shape: ", shape)
+    else:
+        print("\nFile: ", filename, "Shape: ", shape, "Tiles: ", tiles)
+
+def prepare_frame(img, width):
+    '''prepare_image for a frame that has already been decoded'''
+    with metrics.timer('preprocess'):
+        return to_input(cv2.resize(img, (width, width)))
+
 def prepareNDArray(filename, width):
     '''load the specified image, and adjust it for input into the network.
     the image will be scaled (preserving aspect ratio) to the width passed in
     this allows experiments to understand input resolution basis
     inference accuracy'''
-    img = cv2.imread(filename)
-    img = cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
-    (h, w) = img.shape[:2]
-    r = width / float(w)
-    dim = (width, int(h * r))
-    dim = (width, width)
-    img = cv2.resize(img, dim)
-    img = np.swapaxes(img, 0, 2)
-    img = np.swapaxes(img, 1, 2)
+    import mxnet as mx
+    img = prepare_image(filename, width)
+    print_prepared(filename, img.shape)
     img = img[np.newaxis, :]
-    print("\nFile: ", filename, "Shape: ", img.shape)
     return mx.nd.array(img)
 
-def predict(filename, model, n, scale_width):
+def collate_batch(images, batch_size):
+    '''stack the (3, H, W) images into a single (batch_size, 3, H, W) NDArray,
+    a short (last) batch is padded out with zero filled images'''
+    import mxnet as mx
+    batch = np.zeros((batch_size,) + images[0].shape, dtype=np.float32)
+    for i, img in enumerate(images):
+        batch[i] = img
+    return mx.nd.array(batch)
+
+def prefetch_images(filenames, width, workers, depth, prepare=prepare_image):
+    '''producer side of the inference pipeline, a pool of worker threads
+    decode and preprocess filenames (cv2 drops the GIL while it works)
+    and yields (filename, prepare(filename, width)) in the original order.
+    at most depth images are in flight or waiting so memory stays bounded
+    if inference falls behind.  files that can't be read are skipped'''
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as pool:
+        files = iter(filenames)
+        pending = deque((f, pool.submit(prepare, f, width))
+                        for f in islice(files, max(1, depth)))
+        while pending:
+            f, future = pending.popleft()
+            # top the queue back up before blocking on the oldest entry
+            nextf = next(files, None)
+            if nextf is not None:
+                pending.append((nextf, pool.submit(prepare, nextf, width)))
+            if metrics.enabled():
+                metrics.gauge('prefetch_queue_depth', sum(p.done() for _, p in pending))
+            try:
+                prepared = future.result()
+            except (OSError, ValueError) as ex:
+                print(sys.argv[0], ": skipping", f, ex, file=sys.stderr)
+                continue
+            yield f, prepared
+
+def forward(model, batch):
+    '''run the (batch_size, 3, H, W) NDArray batch through the model and
+    return the output NDArray (still on the device).  mxnet runs the
+    forward pass asynchronously, most of its time usually shows up in the
+    'outputs' stage that waits for it when copying the outputs back'''
+    Batch = namedtuple('Batch', ['data'])
+    with metrics.timer('forward'):
+        model.forward(Batch([batch]))
+        return model.get_outputs()[0]
+
+def detection_filter(args):
+    '''the postprocess.Filter of the --nbbox, --thresh, --topk and --nms args'''
+    return postprocess.Filter(args.nbbox, args.thresh, args.topk, args.nms)
+
+def detect_images(images, model, flt=postprocess.Filter()):
+    '''collate the preprocessed images into a single batch matching the batch
+    size the model was bound with and run one forward pass.
+    returns the postprocess.DETECTION array of the boxes of each image the
+    postprocess.Filter flt keeps.
+    NMS runs on the device with the outputs before they are copied back'''
+    import mxnet as mx
+    t1 = time.time()
+    batch_size = model.data_shapes[0].shape[0]
+    with metrics.timer('collate'):
+        batch = collate_batch(images, batch_size)
+    out = forward(model, batch)
+    with metrics.timer('outputs'):
+        if flt.nms > 0:
+            out = mx.nd.contrib.box_nms(out, overlap_thresh=flt.nms, valid_thresh=flt.thresh,
+                                        topk=-1,
+                                        coord_start=2, score_index=1, id_index=0,
+                                        force_suppress=False)
+        prob = out.asnumpy()
+    with metrics.timer('postprocess'):
+        det = postprocess.detections(prob, len(images), flt._replace(nms=0.0))
+    elapsed = time.time() - t1
+    print("Predicted %d images in %2.8f seconds (%2.2f images/sec)" %
+          (len(images), elapsed, len(images) / elapsed))
+    return det
+
+def detect_tiled(tiled, model, flt=postprocess.Filter()):
+    '''run the (batch, origins, shape) tiles of an image from prepare_tiles
+    through the model in one forward pass, the model is reshaped to the
+    number of tiles if it was bound with another batch size.  returns the
+    (labels, scores, bbox) of the whole image filtered by the
+    postprocess.Filter flt, duplicates found in overlapping tiles are merged
+    with NMS (flt.nms, or tiling.MERGE_OVERLAP)'''
+    import mxnet as mx
+    t1 = time.time()
+    batch, origins, shape = tiled
+    if model.data_shapes[0].shape != batch.shape:
+        model.reshape(data_shapes=[('data', batch.shape)])
+    with metrics.timer('collate'):
+        batch = mx.nd.array(batch)
+    out = forward(model, batch)
+    with metrics.timer('outputs'):
+        prob = out.asnumpy()
+    with metrics.timer('postprocess'):
+        det = postprocess.from_outputs(prob, len(origins), flt.thresh)
+        # --nms applies even to an image that fits in one tile, without it
+        # only the duplicates of neighbouring tiles are merged
+        overlap = flt.nms or (tiling.MERGE_OVERLAP if len(origins) > 1 else 0.0)
+        det = tiling.merge(det, origins, tiled[0].shape[-1], shape, overlap)
+        det = postprocess.limit(det, flt.topk, flt.nbbox)
+    elapsed = time.time() - t1
+    print("Predicted %d tiles in %2.8f seconds (%2.2f tiles/sec)" %
+          (len(origins), elapsed, len(origins) / elapsed))
+    return postprocess.split(det, 1)[0]
+
+def predict_images(images, model, flt=postprocess.Filter()):
+    '''detect_images split into a list of (labels, scores, bbox) one per image'''
+    return postprocess.split(detect_images(images, model, flt), len(images))
+
+def predict_batch(filenames, model, n, scale_width, flt=postprocess.Filter()):
+    '''Load the specified images, collate them into a single batch matching
+    the batch size the model was bound with and run one forward pass.
+    returns a list of (labels, scores, bbox) one per filename, the top n
+    boxes of those the postprocess.Filter flt keeps'''
+    images = [prepare_image(f, scale_width) for f in filenames]
+    for f, img in zip(filenames, images):
+        print_prepared(f, img.shape)
+    return predict_images(images, model, flt._replace(nbbox=n))
+
+def predict(filename, model, n, scale_width, flt=postprocess.Filter()):
     '''Load the specified image, prepair it for input into the network
     take the top n retuned predictions and split into parallel np arrays
     labels, scores, and bounding box'''
-    t1 = time.time()
-    array = prepareNDArray(filename, scale_width)
-    Batch = namedtuple('Batch', ['data'])
-    model.forward(Batch([array]))
-    prob = model.get_outputs()[0].asnumpy()
-    prob = np.squeeze(prob)
-    print("Predicted in %2.8f seconds" % (time.time() -t1))
-    a = prob[0:n]
-    for z in a:
-        if z[0] >= 0:
-            print(z)
-    r, _ = a.shape
-    lab = np.reshape(a[:, 0], (r, 1))
-    score = np.reshape(a[:, 1], (r, 1))
-    bbox = a[:, 2:6]
-    return lab, score, bbox
+    return predict_batch([filename], model, n, scale_width, flt)[0]
+
+# BGR colors used to draw boxes, indexed by class id
+COLORS = [(255, 56, 56), (56, 56, 255), (56, 255, 56), (255, 157, 151), (0, 194, 255),
+          (255, 112, 31), (72, 249, 10), (146, 204, 23), (61, 219, 134), (26, 147, 52),
+          (0, 212, 187), (44, 153, 168), (52, 69, 147), (100, 115, 255), (0, 24, 236),
+          (132, 56, 255), (82, 0, 133), (203, 56, 255), (255, 149, 200), (255, 55, 199)]
+
+def draw_label(img, text, corner, color, scale):
+    '''draw text in white on a color box at the (x, y) top left corner of a
+    bounding box, moved down inside the image at its top edge'''
+    thickness = max(1, int(round(2 * scale)))
+    (tw, th), base = cv2.getTextSize(text, cv2.FONT_HERSHEY_SIMPLEX,
+                                     0.5 * scale + 0.25, thickness)
+    x, y = corner[0], max(corner[1], th + base)
+    cv2.rectangle(img, (x, y - th - base), (x + tw, y), color, cv2.FILLED)
+    cv2.putText(img, text, (x, y - base), cv2.FONT_HERSHEY_SIMPLEX,
+                0.5 * scale + 0.25, (255, 255, 255), thickness, cv2.LINE_AA)
+
+def draw_detections(img, detection, thresh, class_names):
+    '''draw the bounding boxes, class names and scores >= thresh of the
+    (labels, scores, bbox) detection returned by predict directly onto img
+    (a BGR numpy frame, modified in place) using cv2, so no display or
+    matplotlib canvas is needed'''
+    labels, scores, bbox = detection
+    # width, height, width, height of img to scale the normalized boxes
+    dims = np.tile(img.shape[1::-1], 2)
+    scale = max(dims) / 1000.0
+    for box, score, cid in zip(bbox, scores.ravel(), labels.ravel().astype(int)):
+        if cid < 0 or score < thresh:
+            continue
+        color = COLORS[cid % len(COLORS)]
+        box = [int(v) for v in box * dims]
+        cv2.rectangle(img, tuple(box[:2]), tuple(box[2:]), color, max(1, int(round(2 * scale))))
+        name = class_names[cid] if cid < len(class_names) else str(cid)
+        draw_label(img, '%s %.3f' % (name, score), box[:2], color, scale)
+    return img
+
+def batches(items, batch_size):
+    '''yield successive batch_size lists from the items iterable, the last
+    may be short'''
+    chunk = []
+    for item in items:
+        chunk.append(item)
+        if len(chunk) == batch_size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+def plot_detections(img, detection, thresh, class_names):
+    '''show the (labels, scores, bbox) detection on a BGR image in a
+    matplotlib window'''
+    from matplotlib import pyplot as plt
+    from gluoncv import utils
+    labels, scores, bbox = detection
+    plt.close()
+    utils.viz.plot_bbox(cv2.cvtColor(img, cv2.COLOR_BGR2RGB), bbox,
+                        scores=scores, labels=labels,
+                        thresh=thresh, class_names=class_names,
+                        absolute_coordinates=False)
+    plt.show(block=False)
+
+def print_detections(filename, labels, scores, bbox):
+    '''print the label, score, bbox rows of the detections in a file'''
+    print("Detections in", filename)
+    if len(labels):
+        print(np.hstack([labels, scores, bbox]))
+
+def warm_up(model, width):
+    '''run a blank batch through the model so the first real request does
+    not pay for allocating the executor memory'''
+    predict_images([np.zeros((3, width, width), dtype=np.uint8)], model,
+                   postprocess.Filter(nbbox=1))
+
+def make_handler(model, classnames, args, cache=None):
+    '''the detectserver request handler for a model loaded as the parsed
+    args say, images are decoded on a thread pool of args.workers (or taken
+    from cache), the forward passes are serialized'''
+    lock = threading.Lock()
+    pool = ThreadPoolExecutor(max_workers=max(1, args.workers))
+    batch_size = model.data_shapes[0].shape[0]
+    prefix, width = os.path.abspath(args.prefix), args.width
+
+    def handle(request):
+        if request.get('cmd') == 'info':
+            return {'prefix': prefix, 'width': width, 'batch_size': batch_size,
+                    'classnames': classnames}
+        if request.get('cmd') != 'detect':
+            raise ValueError("unknown command %s" % request.get('cmd'))
+        if 'images' in request:
+            images = list(pool.map(lambda b: prepare_bytes(base64.b64decode(b), width),
+                                   request['images']))
+        else:
+            images = list(pool.map(lambda f: prepare_image(f, width, cache),
+                                   request['files']))
+            for f, img in zip(request['files'], images):
+                print_prepared(f, img.shape)
+        flt = postprocess.Filter(request.get('nbbox', 5), request.get('thresh', 0.0),
+                                 request.get('topk', 0), request.get('nms', 0.0))
+        results = []
+        with lock:
+            for chunk in batches(images, batch_size):
+                results += predict_images(chunk, model, flt)
+        return {'results': [detectserver.encode_result(*r) for r in results]}
+    return handle
+
+def connect_server(path, prefix, width):
+    '''connect to the detection server at path, None if there is none or it
+    is running another model or input width'''
+    client = detectserver.connect(path)
+    if client is None:
+        print("No detection server on", path, "loading the model")
+        return None
+    info = client.info()
+    if info['prefix'] != os.path.abspath(prefix) or info['width'] != width:
+        print("Detection server on", path, "runs", info['prefix'], "at", info['width'],
+              "loading the model")
+        client.close()
+        return None
+    print("Using detection server on", path)
+    return client
+
+def queue_depth(args):
+    '''the number of prepared images read ahead, --queue-depth or 4 batches'''
+    return args.queue_depth if args.queue_depth > 0 else 4 * args.batch_size
+
+def keeps_frame(args):
+    '''whether the decoded images are going to be shown or recorded'''
+    return not args.noplt or bool(args.record)
+
+def tiled_detections(files, model, args, dataset=None):
+    '''local_detections of --tile, each image is cut into tiles of the
+    network width that run through the model in one forward pass'''
+    keep_frame = keeps_frame(args)
+    flt = detection_filter(args)
+    # an image is a whole batch of tiles, so read fewer of them ahead
+    ready = prefetch_images(files, args.width, args.workers, max(1, queue_depth(args) // 4),
+                            partial(prepare_tiles, overlap=args.tile_overlap, dataset=dataset))
+    for f, (tiled, frame) in ready:
+        print_prepared(f, tiled[2], len(tiled[1]))
+        labels, scores, bbox = detect_tiled(tiled, model, flt)
+        print_detections(f, labels, scores, bbox)
+        yield f, frame if keep_frame else None, labels, scores, bbox
+
+def input_preparer(args, cache=None, dataset=None):
+    '''the prefetch_images prepare function of the files of local_detections,
+    the frames are kept if they are going to be shown or recorded'''
+    if dataset is None:
+        return partial(prepare_file, cache=cache, keep_frame=keeps_frame(args))
+    return partial(prepare_record, dataset=dataset, keep_frame=keeps_frame(args))
+
+def local_detections(files, model, args, cache=None, dataset=None):
+    '''yield (filename, frame, labels, scores, bbox) running the model in
+    process, frame is the decoded image when it is going to be shown or
+    recorded (so it isn't decoded again for that) otherwise None.  with a
+    packset.PackedDataset the files are its record names'''
+    if args.tile:
+        yield from tiled_detections(files, model, args, dataset)
+        return
+    ready = prefetch_images(files, args.width, args.workers,
+                            max(queue_depth(args), args.batch_size),
+                            input_preparer(args, cache, dataset))
+    flt = detection_filter(args)
+    for chunk in batches(ready, args.batch_size):
+        for f, (img, _) in chunk:
+            print_prepared(f, img.shape)
+        results = predict_images([img for _, (img, _) in chunk], model, flt)
+        for (f, (_, frame)), (labels, scores, bbox) in zip(chunk, results):
+            print_detections(f, labels, scores, bbox)
+            yield f, frame, labels, scores, bbox
+
+def remote_detections(files, client, args, dataset=None):
+    '''yield (filename, None, labels, scores, bbox) from the detection server,
+    the records of a packset.PackedDataset are sent as image bytes'''
+    for chunk in batches(files, args.batch_size):
+        if dataset is None:
+            results = client.detect_files(chunk, *detection_filter(args))
+        else:
+            results = client.detect_images([dataset.jpeg(dataset.position(f)) for f in chunk],
+                                           *detection_filter(args))
+        for f, (labels, scores, bbox) in zip(chunk, results):
+            print_detections(f, labels, scores, bbox)
+            yield f, None, labels, scores, bbox
+
+def detect_frame(img, model, args):
+    '''(labels, scores, bbox) of a decoded BGR frame, tiled with --tile'''
+    if args.tile:
+        origins = tiling.tile_origins(img.shape, args.width, args.tile_overlap)
+        tiled = (tiling.tile_batch(img, origins, args.width), origins, img.shape)
+        return detect_tiled(tiled, model, detection_filter(args))
+    return predict_images([prepare_frame(img, args.width)], model, detection_filter(args))[0]
+
+def stream_recorder(reader, args):
+    '''the asynchronous DVR of --record at the processed frame rate of the
+    videostream.FrameReader reader, None without --record'''
+    if not args.record:
+        return None
+    rate = reader.fps / reader.stride if reader.fps else 10
+    return dvr.DVR(path='.', frame_rate=max(1, int(round(rate))),
+                   options=dvr.Options(asynchronous=True, pretrigger=args.pretrigger))
+
+def record_detections(recorder, img, captured, labels):
+    '''start (or extend) a clip of recorder if there are labels and record the
+    frame img captured at that time while a clip is active'''
+    if len(labels):
+        recorder.activate_recording()
+    # frames skipped to keep up are filled in so clips play in real time
+    recorder.record_frame_if_active(img, captured)
+
+def print_stream_summary(reader, latencies, elapsed):
+    '''print the frames processed out of those read in elapsed seconds and
+    their latencies'''
+    if latencies:
+        print("Processed %d of %d frames in %2.2f seconds (%2.2f frames/sec), "
+              "latency mean %2.2f max %2.2f milliseconds" %
+              (len(latencies), reader.frames_read, elapsed, len(latencies) / elapsed,
+               1000 * sum(latencies) / len(latencies), 1000 * max(latencies)))
+
+def stream(model, classnames, args):
+    '''run detection on the frames of args.video as they are decoded by a
+    videostream.FrameReader, with args.record a DVR clip is started (or
+    extended) whenever a frame has a detection >= args.thresh.  prints
+    the latency of each frame (capture to detections) and the processed
+    frame rate'''
+    reader = videostream.FrameReader(args.video, args.stride, not args.no_skip)
+    recorder = stream_recorder(reader, args)
+    print("Streaming", args.video, "at %2.2f fps" % reader.fps, "stride", reader.stride)
+    latencies = []
+    start = report = time.time()
+    while True:
+        frame = reader.read()
+        if frame is None:
+            break
+        index, captured, img = frame
+        detection = detect_frame(img, model, args)
+        latency = time.time() - captured
+        latencies.append(latency)
+        metrics.observe('frame_latency', latency)
+        metrics.gauge('stream_frames_dropped', reader.frames_dropped)
+        print("Frame %d: %d detections, latency %2.2f milliseconds" %
+              (index, len(detection[0]), latency * 1000))
+        if recorder is not None or not args.noplt:
+            with metrics.timer('draw'):
+                draw_detections(img, detection, args.thresh, classnames)
+        if recorder is not None:
+            record_detections(recorder, img, captured, detection[0])
+        if not args.noplt:
+            cv2.imshow('detectimg', img)
+            if cv2.waitKey(1) & 0xFF == ord('q'):
+                break
+        if time.time() - report >= 5:
+            report = time.time()
+            print("Processed %2.2f frames/sec, %d frames dropped to keep up" %
+                  (len(latencies) / (report - start), reader.frames_dropped))
+    elapsed = max(time.time() - start, 1e-9)
+    reader.close()
+    if recorder is not None:
+        recorder.close()
+    if not args.noplt:
+        cv2.destroyAllWindows()
+    print_stream_summary(reader, latencies, elapsed)
 
 # Load network and catagories
-def init(modelname, catfilename):
+def init(modelname, catfilename, batch_size=1, width=416):
     '''Setup the mode and load the label catagories
     '''
-    model = loadModel(modelname)
+    model = loadModel(modelname, batch_size, width)
     cats = loadCategories(catfilename)
     print("loaded model:", modelname, "class names:", catfilename)
     return model, cats
 
 
-ARGS = parse_args()
-NET, CLASSNAMES = init(ARGS.prefix, ARGS.synset)
-dvr1=None
+def main(argv=None):
+    '''run detection as the command line (or argv) specifies'''
+    args = parse_args(argv)
+    if args.batch_size < 1:
+        print("--batch-size must be at least 1")
+        sys.exit()
+
+    if args.metrics or args.metrics_port or args.metrics_log > 0:
+        metrics.enable(args.metrics, args.metrics_port, args.metrics_log)
+    try:
+        run(args)
+    finally:
+        metrics.close()
+
+def run(args):
+    '''run detection with the parsed args'''
+    cache_mb = args.cache_mb if args.cache_mb is not None else (256 if args.serve else 0)
+    cache = None
+    if cache_mb > 0 or args.cache_dir:
+        cache = imgcache.ImageCache(cache_mb << 20, args.cache_dir, args.cache_dir_mb << 20)
 
-if ARGS.noplt and args.record:
-    print(argv[0]+": --noplt overridden by --record")
-    args.noplt = False
+    if args.serve:
+        run_server(args, cache)
+    elif args.video:
+        net, classnames = init(args.prefix, args.synset, args.batch_size, args.width)
+        stream(net, classnames, args)
+    else:
+        run_files(args, cache)
 
-if ARGS.record:
-    dvr1 = dvr.DVR(path='.', frame_rate=3)
-    dvr1.activate_recording(duration=2000)
+def run_server(args, cache=None):
+    '''load the model and serve detection requests on args.serve'''
+    try:
+        # fail before the model is loaded rather than after
+        detectserver.remove_stale_socket(args.serve)
+    except OSError as ex:
+        print("Can't serve on", args.serve + ":", ex.strerror)
+        sys.exit(1)
+    net, classnames = init(args.prefix, args.synset, args.batch_size, args.width)
+    warm_up(net, args.width)
+    detectserver.serve(args.serve, make_handler(net, classnames, args, cache))
 
-if ARGS.args:
-    # use files from command line
-    FILES = ARGS.args
-else:
+def input_files(args):
+    '''(files, dataset) the detections are run on, dataset is the
+    packset.PackedDataset of --pack (None without it) whose record names the
+    files are'''
+    if args.pack:
+        # use the records of the packset, or the ones named on the command line
+        if not packset.exists(args.pack):
+            print("Can't access packset", args.pack)
+            sys.exit()
+        dataset = packset.PackedDataset(args.pack)
+        return (args.args if args.args else dataset.names), dataset
+    if args.args:
+        # use files from command line
+        return args.args, None
     # use files in the specified imagedir
-    FILES = [os.path.join(ARGS.imagedir, x)
-             for x in fnmatch.filter(os.listdir(ARGS.imagedir), '*.jpg')]
-
-print("Using model:", ARGS.prefix, "scaling to:", ARGS.width)
-
-for f in FILES:
-    labels, scores, bbox = predict(f, NET, ARGS.nbbox, ARGS.width)
-    if not ARGS.noplt:
-        img = cv2.imread(f)
-        img = cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
-        plt.close()
-        ax = utils.viz.plot_bbox(img, bbox, scores=scores, labels=labels,
-                                 thresh=ARGS.thresh, class_names=CLASSNAMES,
-                                 absolute_coordinates=False)
-        plt.show(block=False)
-        plt.savefig ('out.png')
-        img2 = cv2.imread ('out.png')
-        dvr1.record_frame_if_active (img2)
-        plt.pause(ARGS.pause)
+    return (e.path for e in dirscan.scan(args.imagedir, recursive=args.recursive)), None
+
+def show_detections(detections, classnames, args, dataset=None, recorder=None):
+    '''plot the (filename, frame, labels, scores, bbox) detections unless
+    --noplt and record them when recorder is a DVR, the image is read again
+    when the frame was not kept'''
+    for f, img, labels, scores, bbox in detections:
+        if args.noplt and recorder is None:
+            continue
+        if img is None:
+            img = cv2.imread(f) if dataset is None else dataset.image(dataset.position(f))
+        if not args.noplt:
+            with metrics.timer('plot'):
+                plot_detections(img, (labels, scores, bbox), args.thresh, classnames)
+        if recorder is not None:
+            with metrics.timer('draw'):
+                draw_detections(img, (labels, scores, bbox), args.thresh, classnames)
+            recorder.record_frame_if_active(img)
+        if not args.noplt:
+            from matplotlib import pyplot as plt
+            plt.pause(args.pause)
+
+def run_files(args, cache=None):
+    '''run detection on the files, imagedir or packset of args in process
+    or on the detection server'''
+    client = None
+    if args.server and args.tile:
+        print("--tile runs in process, not on the detection server")
+    elif args.server:
+        client = connect_server(args.server, args.prefix, args.width)
+    if client is None:
+        net, classnames = init(args.prefix, args.synset, args.batch_size, args.width)
+    else:
+        classnames = client.info()['classnames']
+    dvr1 = None
+
+    if args.record:
+        dvr1 = dvr.DVR(path='.', frame_rate=3, options=dvr.Options(asynchronous=True))
+        dvr1.activate_recording(duration=2000)
+
+    files, dataset = input_files(args)
+
+    print("Using model:", args.prefix, "scaling to:", args.width)
+
+    if client is None:
+        detections = local_detections(files, net, args, cache, dataset)
+    else:
+        detections = remote_detections(files, client, args, dataset)
+    show_detections(detections, classnames, args, dataset, dvr1)
+
+    if client is not None:
+        client.close()
+    if dvr1 is not None:
+        dvr1.close()
+    if dataset is not None:
+        dataset.close()
+    if cache is not None:
+        print("Image cache: %d hits, %d from %s, %d decoded" %
+              (cache.hits, cache.disk_hits, args.cache_dir, cache.misses))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,150 @@
+'''Local detection server so the model stays loaded between runs.
+#
+# Loading the checkpoint and binding the Module costs far more than running
+# a few images, so detectimg.py --serve SOCKET loads the model once, warms
+# it up and answers requests on a unix domain socket.  detectimg.py
+# --server SOCKET is then a thin client that sends it file names, and falls
+# back to loading the model itself if no server is listening (or it was
+# started with a different model or width).
+#
+# The protocol is one JSON object per line each way:
+#   {"cmd": "info"}
+#       -> {"prefix": ..., "width": ..., "batch_size": ..., "classnames": [...]}
+#   {"cmd": "detect", "files": [absolute paths], "nbbox": n, ...}
+#   {"cmd": "detect", "images": [base64 encoded jpg bytes], "nbbox": n, ...}
+#       -> {"results": [{"labels": [...], "scores": [...], "bbox": [[...]]}, ...]}
+# and {"error": message} if something went wrong.  A detect request can
+# also set the postprocessing "thresh", "topk" and "nms" (see postprocess.py).
+#'''
+import os
+import stat
+import errno
+import json
+import base64
+import socket
+import socketserver
+import numpy as np
+
+
+def encode_result(labels, scores, bbox):
+    '''the JSON form of one image's (labels, scores, bbox)'''
+    return {'labels': np.asarray(labels).ravel().tolist(),
+            'scores': np.asarray(scores).ravel().tolist(),
+            'bbox': np.asarray(bbox).tolist()}
+
+
+def decode_result(result):
+    '''(labels, scores, bbox) arrays shaped like detectimg.predict returns'''
+    labels = np.array(result['labels'], dtype=np.float32).reshape(-1, 1)
+    scores = np.array(result['scores'], dtype=np.float32).reshape(-1, 1)
+    bbox = np.array(result['bbox'], dtype=np.float32).reshape(-1, 4)
+    return labels, scores, bbox
+
+
+def remove_stale_socket(path):
+    '''delete the socket at path if no server is listening on it any more,
+    raises OSError if path is something else or a server is still running'''
+    try:
+        mode = os.lstat(path).st_mode
+    except FileNotFoundError:
+        return
+    if not stat.S_ISSOCK(mode):
+        raise OSError(errno.EEXIST, '%s exists and is not a socket' % path)
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(path)
+    except ConnectionRefusedError:
+        os.unlink(path)
+        return
+    finally:
+        sock.close()
+    raise OSError(errno.EADDRINUSE, 'a server is already running on %s' % path)
+
+
+def serve(path, handle):
+    '''answer requests on the unix socket at path until interrupted, handle
+    is called with each request dict and returns the response dict.
+    Connections are served on their own threads, handle must do its own
+    locking around anything that isn't thread safe (the model).  raises
+    OSError if path is in use (see remove_stale_socket)'''
+    remove_stale_socket(path)
+
+    class Handler(socketserver.StreamRequestHandler):
+        '''read a JSON request per line, write a JSON response per line'''
+        def handle(self):
+            for line in self.rfile:
+                try:
+                    response = handle(json.loads(line))
+                except Exception as ex:  # pylint: disable=broad-except
+                    response = {'error': str(ex)}
+                self.wfile.write(json.dumps(response).encode() + b'\n')
+                self.wfile.flush()
+
+    server = socketserver.ThreadingUnixStreamServer(path, Handler)
+    server.daemon_threads = True
+    print("Serving detections on", path)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        os.unlink(path)
+
+
+class Client:
+    '''Connection to a running detection server'''
+    def __init__(self, path, timeout=None):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.settimeout(timeout)
+        try:
+            self.sock.connect(path)
+        except OSError:
+            self.sock.close()
+            raise
+        self.rfile = self.sock.makefile('rb')
+
+    def request(self, message):
+        '''send a request and return the response, raises IOError if the
+        server reports an error'''
+        self.sock.sendall(json.dumps(message).encode() + b'\n')
+        line = self.rfile.readline()
+        if not line:
+            raise IOError("detection server closed the connection")
+        response = json.loads(line)
+        if 'error' in response:
+            raise IOError(response['error'])
+        return response
+
+    def info(self):
+        '''prefix, width, batch_size and classnames of the server's model'''
+        return self.request({'cmd': 'info'})
+
+    def detect_files(self, filenames, nbbox, thresh=0.0, topk=0, nms=0.0):
+        '''run detection on files the server can read, returns a list of
+        (labels, scores, bbox) one per file'''
+        response = self.request({'cmd': 'detect', 'nbbox': nbbox, 'thresh': thresh,
+                                 'topk': topk, 'nms': nms,
+                                 'files': [os.path.abspath(f) for f in filenames]})
+        return [decode_result(r) for r in response['results']]
+
+    def detect_images(self, jpgs, nbbox, thresh=0.0, topk=0, nms=0.0):
+        '''run detection on encoded image bytes, returns a list of
+        (labels, scores, bbox) one per image'''
+        response = self.request({'cmd': 'detect', 'nbbox': nbbox, 'thresh': thresh,
+                                 'topk': topk, 'nms': nms,
+                                 'images': [base64.b64encode(b).decode('ascii') for b in jpgs]})
+        return [decode_result(r) for r in response['results']]
+
+    def close(self):
+        '''close the connection'''
+        self.rfile.close()
+        self.sock.close()
+
+
+def connect(path, timeout=None):
+    '''a Client connected to the server at path, None if none is running'''
+    try:
+        return Client(path, timeout)
+    except OSError:
+        return None
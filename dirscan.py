@@ -0,0 +1,62 @@
+'''Streaming directory scanner shared by the scripts.
+#
+# scan() walks a directory with os.scandir and yields each matching file as
+# it is found, so a script can start work before a huge directory has been
+# listed.  Extensions match case insensitively (.jpg, .JPG, .jpeg ...),
+# subdirectories are walked when recursive=True (symlinked directories are
+# not followed, so there are no loops), and each entry carries the
+# size and mtime from the stat scandir already did (free on Windows, one
+# cached stat per file elsewhere) for incremental processing.
+#
+#  for entry in scan('data/train', recursive=True):
+#      entry.path       data/train/sub/img0.jpg
+#      entry.relpath    sub/img0.jpg  (relative to the directory scanned)
+#      entry.size, entry.mtime_ns
+#      label_path(entry.path)  ->  data/train/sub/img0.txt
+#'''
+import os
+from collections import namedtuple
+
+ScanEntry = namedtuple('ScanEntry', ['path', 'relpath', 'name', 'size', 'mtime_ns'])
+
+JPG_EXTENSIONS = ('.jpg', '.jpeg')
+
+
+def scan(top, extensions=JPG_EXTENSIONS, recursive=False):
+    '''yield a ScanEntry for every file in top with one of extensions,
+    walking subdirectories too if recursive.  raises OSError if top itself
+    can't be read, unreadable subdirectories are skipped'''
+    extensions = tuple(e.lower() for e in extensions)
+    pending = ['']
+    while pending:
+        reldir = pending.pop()
+        try:
+            entries = os.scandir(os.path.join(top, reldir) if reldir else top)
+        except OSError:
+            if not reldir:
+                raise
+            continue
+        with entries:
+            for entry in entries:
+                try:
+                    if entry.is_dir(follow_symlinks=False):
+                        if recursive:
+                            pending.append(os.path.join(reldir, entry.name))
+                        continue
+                    if not entry.name.lower().endswith(extensions) or not entry.is_file():
+                        continue
+                    st = entry.stat()
+                except OSError:
+                    continue
+                yield ScanEntry(entry.path, os.path.join(reldir, entry.name), entry.name,
+                                st.st_size, st.st_mtime_ns)
+
+
+def stem(path):
+    '''path without its extension'''
+    return os.path.splitext(path)[0]
+
+
+def label_path(jpgpath):
+    '''the yolo_mark label file that goes with an image'''
+    return stem(jpgpath) + '.txt'
@@ -18,8 +18,40 @@
 #              multiple times to get longer clips)
 #  frame_rate  default = 2, number of seconds for the frame to show in the mp4
 #  trace       default=False, diagnostic print messages
+#  options     an Options tuple of the settings below, default Options()
+#  asynchronous default=False, resize and encode frames on a background
+#              writer thread so record_frame_if_active does not stall the
+#              caller, frames wait in a queue of at most queue_size frames
+#  queue_size  default=32, max frames waiting for the writer thread
+#  overflow    default='block', what to do when the queue is full:
+#              'block' wait for room, 'drop-oldest' discard the oldest
+#              queued frame, 'drop-newest' discard the frame being added
+#
+#  pretrigger  default=0, seconds of frames to keep from before
+#              activate_recording() is called, they are written at the
+#              start of the new clip.  frames are held already resized in a
+#              preallocated ring buffer of pretrigger * frame_rate frames
+#              (frames are expected to arrive at roughly frame_rate), a
+#              FrameRing, so memory use is fixed however long the DVR runs
+#
+#  record_frame_if_active(frame, timestamp) with the time.time() the frame
+#  was captured keeps a clip in real time when frames arrive slower than
+#  frame_rate (a live source where frames are skipped to keep up): each
+#  frame is repeated until the next one's timestamp is reached.  Frames
+#  with no timestamp take one frame_rate tick each.
+#
+#  frames_written and frames_dropped count what happened to the frames
+#  passed in.  In asynchronous mode the frame is queued by reference so
+#  it must not be modified after it is passed in, call flush() to wait for
+#  the queue to drain and close() to drain it and stop the writer thread.
+#  The queue and writer thread are a FrameWriter, a frame the writer thread
+#  fails to encode is counted in write_errors and the queue keeps draining.
+#  With metrics enabled record_frame_if_active and the resize and encode of
+#  each frame are timed (dvr_record, dvr_encode) and the queue depth and
+#  dropped frames are exported too.
 #
 # dvr = DVR(path=".", duration=5, trace=True)
+# dvr = DVR(path=".", options=Options(asynchronous=True, pretrigger=2))
 # in while loop:
 #    ...
 #    if (record_event):     #if an event occurs, start recording it
@@ -28,17 +60,207 @@
 #    recording is active, else it no-ops
 #
 #  calling stop_recording is not required, but will immediately expire
-#  the duration and stop any active recording.'''
+#  the duration and stop any active recording.
+#  call close() when done to finish and release any open mp4 file.'''
 import os
+import sys
 import time
+import threading
+from collections import deque, namedtuple
+import numpy as np
 import cv2
+import metrics
+
+OVERFLOW_POLICIES = ('block', 'drop-oldest', 'drop-newest')
+
+# the frame writer and pre-trigger settings of a DVR, see above
+Options = namedtuple('Options', ['asynchronous', 'queue_size', 'overflow', 'pretrigger'],
+                     defaults=(False, 32, 'block', 0))
+
+class FrameRing:
+    '''Preallocated ring buffer of the last frames resized to resolution
+    and the time each was captured'''
+    def __init__(self, capacity, resolution):
+        (width, height) = resolution
+        self.frames = np.zeros((capacity, height, width, 3), dtype=np.uint8)
+        self.times = np.zeros(capacity, dtype=np.float64)
+        # True if the frames came with a capture timestamp
+        self.timestamped = False
+        # the slot the next frame goes into and how many slots hold frames
+        self.next = 0
+        self.count = 0
+
+    def add(self, frame, timestamp=None):
+        '''Resize frame into the oldest slot, reusing its storage'''
+        slot = self.frames[self.next]
+        resized = cv2.resize(frame, (slot.shape[1], slot.shape[0]), dst=slot)
+        if resized is not slot:
+            slot[...] = resized
+        self.times[self.next] = time.time() if timestamp is None else timestamp
+        self.timestamped = timestamp is not None
+        self.next = (self.next + 1) % len(self.frames)
+        self.count = min(self.count + 1, len(self.frames))
+
+    def take(self, oldest):
+        '''(frame, timestamp) of the buffered frames captured at or after
+        oldest, oldest first, and empty the ring.  the frames are views of
+        slots that are reused, timestamp is None for frames added without
+        one'''
+        capacity = len(self.frames)
+        first = (self.next - self.count) % capacity
+        taken = []
+        for i in range(self.count):
+            idx = (first + i) % capacity
+            if self.times[idx] >= oldest:
+                taken.append((self.frames[idx], self.times[idx] if self.timestamped else None))
+        self.count = 0
+        return taken
+
+class FrameWriter:
+    '''Resize and encode frames into cv2.VideoWriters, in the caller or on
+    a background thread fed by a bounded queue'''
+    def __init__(self, resolution, options=Options()):
+        if options.overflow not in OVERFLOW_POLICIES:
+            raise Exception("Invalid overflow policy")
+        self.resolution = resolution
+        self.options = options._replace(queue_size=max(1, options.queue_size))
+        self.written = 0
+        self.dropped = 0
+        self.errors = 0
+        # (video_writer, frame, repeat) waiting for the writer thread, a
+        # frame of None asks the writer thread to release that video_writer
+        self._pending = deque()
+        self._queued_frames = 0
+        self._writing = False
+        self._closing = False
+        self._cond = threading.Condition()
+        self._thread = None
+        if options.asynchronous:
+            self._thread = threading.Thread(target=self.__loop, name='dvr-writer',
+                                            daemon=True)
+            self._thread.start()
+
+    @property
+    def asynchronous(self):
+        '''True if frames are written on the writer thread'''
+        return self.options.asynchronous
+
+    def submit(self, writer, frame, repeat=1):
+        '''Write frame repeat times (or release the writer if frame is None)
+        now, or in asynchronous mode queue it for the writer thread applying
+        the overflow policy when the queue is full'''
+        if self._thread is None:
+            if self._closing and self.asynchronous:
+                raise Exception("DVR is closed")
+            self.__write(writer, frame, repeat)
+            if frame is not None:
+                self.written += 1
+            return
+        with self._cond:
+            self.__check_running()
+            if frame is not None:
+                while self._queued_frames >= self.options.queue_size:
+                    if self.options.overflow == 'drop-newest':
+                        self.dropped += 1
+                        metrics.count('dvr_frames_dropped')
+                        return
+                    if self.options.overflow == 'drop-oldest':
+                        self.__drop_oldest()
+                    else:
+                        self.__wait()
+                self._queued_frames += 1
+            self._pending.append((writer, frame, repeat))
+            metrics.gauge('dvr_queue_depth', self._queued_frames)
+            self._cond.notify_all()
+
+    def flush(self):
+        '''Block until every queued frame has been written'''
+        with self._cond:
+            while self._pending or self._writing:
+                self.__wait()
+
+    def close(self):
+        '''Drain the queue and stop the writer thread'''
+        thread, self._thread = self._thread, None
+        with self._cond:
+            self._closing = True
+            self._cond.notify_all()
+        if thread is not None:
+            thread.join()
+
+    def __check_running(self):
+        '''raise if frames can't be queued, must be called holding self._cond'''
+        if self._closing:
+            raise Exception("DVR is closed")
+        if not self._thread.is_alive():
+            raise Exception("DVR writer thread has stopped")
+
+    def __wait(self):
+        '''wait for the writer thread to make progress, raising if it has
+        died, must be called holding self._cond'''
+        self._cond.wait(1.0)
+        if not self._thread.is_alive():
+            raise Exception("DVR writer thread has stopped")
+
+    def __drop_oldest(self):
+        '''Discard the oldest queued frame, release requests are never dropped
+        must be called holding self._cond'''
+        for i, (_, frame, _) in enumerate(self._pending):
+            if frame is not None:
+                del self._pending[i]
+                self._queued_frames -= 1
+                self.dropped += 1
+                metrics.count('dvr_frames_dropped')
+                return
+
+    def __write(self, writer, frame, repeat=1):
+        '''resize and encode a frame repeat times, or release the writer'''
+        if frame is None:
+            writer.release()
+            return
+        with metrics.timer('dvr_encode'):
+            if (frame.shape[1], frame.shape[0]) != self.resolution:
+                frame = cv2.resize(frame, self.resolution)
+            for _ in range(repeat):
+                writer.write(frame)
+
+    def __loop(self):
+        '''Background thread resizing and encoding queued frames, a frame
+        that fails is counted and logged, the queue keeps draining'''
+        while True:
+            with self._cond:
+                while not self._pending and not self._closing:
+                    self._cond.wait()
+                if not self._pending:
+                    return
+                writer, frame, repeat = self._pending.popleft()
+                if frame is not None:
+                    self._queued_frames -= 1
+                self._writing = True
+                self._cond.notify_all()
+            written = False
+            try:
+                self.__write(writer, frame, repeat)
+                written = frame is not None
+            except Exception as ex:  # pylint: disable=broad-except
+                self.errors += 1
+                metrics.count('dvr_write_errors')
+                print('dvr writer:', 'release' if frame is None else 'frame', 'failed:', ex,
+                      file=sys.stderr)
+            finally:
+                with self._cond:
+                    if written:
+                        self.written += 1
+                    self._writing = False
+                    self._cond.notify_all()
 
 class DVR:
     '''Record short snippets into an MP4
 
     useful for getting the frames after and including a triggering event for short duration.
     if the event reoccurrs during the duration, it will keep recording'''
-    def __init__(self, resolution='480p', path='/tmp', frame_rate=2, trace=False):
+    def __init__(self, resolution='480p', path='/tmp', frame_rate=2, trace=False,
+                 options=Options()):
         super(DVR, self).__init__()
         __resolution = {'1080p' : (1920, 1080), '720p' : (1280, 720), '480p' : (858, 480)}
         if resolution not in __resolution:
@@ -52,8 +274,39 @@ class DVR:
         self.default_duration = 5   # default duration is 10 seconds
         self.clip_duration = self.default_duration
         self.trace = trace
+        self._writer = FrameWriter(self.resolution, options)
+        # capture time of the first frame of the clip and the number of
+        # frame_rate ticks written to it, for timestamped frames
+        self._clip_start = 0.0
+        self._clip_ticks = 0
+        self.pretrigger = options.pretrigger
+        self._ring = None
+        if self.pretrigger > 0:
+            self._ring = FrameRing(max(1, int(np.ceil(self.pretrigger * frame_rate))),
+                                   self.resolution)
         if self.trace:
-            print(vars(self))
+            print({k: v for k, v in vars(self).items() if not k.startswith('_')},
+                  self._writer.options)
+
+    @property
+    def asynchronous(self):
+        '''True if frames are encoded on the writer thread'''
+        return self._writer.asynchronous
+
+    @property
+    def frames_written(self):
+        '''frames resized and encoded into a clip'''
+        return self._writer.written
+
+    @property
+    def frames_dropped(self):
+        '''frames discarded by the overflow policy'''
+        return self._writer.dropped
+
+    @property
+    def write_errors(self):
+        '''frames and releases the writer thread failed to write'''
+        return self._writer.errors
 
     # Open a file to write frames into
     def __start_writer(self):
@@ -69,17 +322,38 @@ class DVR:
                 print('__start_writer: store in ', fname)
 
     # Record a frame IF the record_count is set
-    def record_frame_if_active(self, frame):
+    def record_frame_if_active(self, frame, timestamp=None):
         '''If a clip is being recorded, store it, otherwise
-        turn off recording'''
+        turn off recording.  timestamp is when the frame was captured'''
+        with metrics.timer('dvr_record'):
+            self.__record_frame(frame, timestamp)
+
+    def __record_frame(self, frame, timestamp=None):
+        '''record_frame_if_active without the timer'''
         if time.time() < self.start_time + self.clip_duration:
             if self.trace:
                 print("record_frame_if_active: write image")
             self.__start_writer()
-            self.video_writer.write(cv2.resize(frame, self.resolution))
+            self._writer.submit(self.video_writer, frame, self.__ticks(timestamp))
         else:
             # if we are not in recording mode, then stop recording
             self.stop_recording()
+            if self._ring is not None:
+                self._ring.add(frame, timestamp)
+
+    def __ticks(self, timestamp):
+        '''how many times to write a frame captured at timestamp so the clip
+        reaches it at frame_rate, always at least once'''
+        if timestamp is None:
+            ticks = 1
+        elif self._clip_ticks == 0:
+            self._clip_start = timestamp
+            ticks = 1
+        else:
+            ticks = int(round((timestamp - self._clip_start) * self.frame_rate))
+            ticks = max(1, ticks + 1 - self._clip_ticks)
+        self._clip_ticks += ticks
+        return ticks
 
     def activate_recording(self, duration=-1):
         '''Start recording, set the stat time to now'''
@@ -91,16 +365,47 @@ class DVR:
             self.clip_duration = duration
         #reset the clock counter to extend any active recording session
         self.start_time = time.time()
+        new_clip = self.video_writer is None
         self.__start_writer()
+        if new_clip and self._ring is not None:
+            self.__flush_pretrigger()
 
     def stop_recording(self):
         '''Turn off the recording, and reset the state'''
-        if self.trace:
+        if self.trace and self.video_writer is not None:
             print('stop_recording')
+        if self.video_writer is not None:
+            # release after any frames still queued for this clip
+            self._writer.submit(self.video_writer, None)
         self.video_writer = None
         self.start_time = 0
+        self._clip_ticks = 0
         self.clip_duration = self.default_duration
 
+    def flush(self):
+        '''Block until every queued frame has been written'''
+        self._writer.flush()
+
+    def close(self):
+        '''Stop any active recording, drain the queue, release the mp4 file
+        and stop the writer thread.  The DVR can not be used after close'''
+        self.stop_recording()
+        self._writer.close()
+        if self.trace:
+            print('close: written', self.frames_written, 'dropped', self.frames_dropped,
+                  'errors', self.write_errors)
+
+    def __flush_pretrigger(self):
+        '''Write the buffered frames from the last pretrigger seconds, oldest
+        first, into the clip just started and empty the ring buffer'''
+        buffered = self._ring.take(time.time() - self.pretrigger)
+        for frame, timestamp in buffered:
+            # the queued frame has to outlive the slot being reused
+            frame = frame.copy() if self.asynchronous else frame
+            self._writer.submit(self.video_writer, frame, self.__ticks(timestamp))
+        if self.trace:
+            print('__flush_pretrigger: wrote', len(buffered), 'buffered frames')
+
 
 if __name__ == '__main__':
     dvr = DVR(path=".", trace=True)
@@ -127,3 +432,4 @@ if __name__ == '__main__':
     time.sleep(7)
     dvr.record_frame_if_active(img1)
     dvr.record_frame_if_active(img2)
+    dvr.close()
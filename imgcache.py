@@ -0,0 +1,174 @@
+'''Cache of decoded and resized images shared between runs and tools.
+#
+# Sweeping thresholds or widths over the same validation images decodes
+# and resizes every jpg again on each run.  An ImageCache keeps the
+# result keyed by (absolute path, mtime, size, width), so an image that is
+# changed on disk is simply a different key:
+#
+#   in process   an LRU of arrays bounded by max_bytes
+#   on disk      with store=DIR every entry is also saved as DIR/<hash>.npy
+#                and read back with np.load(mmap_mode='r'), the pages come
+#                straight from the page cache without a decode or a copy.
+#                Any run or tool pointing at the same DIR shares it, it is
+#                trimmed (oldest first) when this process sees it pass
+#                store_max_bytes if that is set
+#
+#  cache = ImageCache(max_bytes=256 << 20, store='/var/cache/imageutil')
+#  img = cache.load('img0.jpg', 416, prepare)   # prepare('img0.jpg', 416)
+#                                                # only if not cached
+#  cache.hits, cache.disk_hits, cache.misses
+#
+# Cached arrays are shared, callers must not modify them (the ones from
+# the disk store are read only).
+#'''
+import os
+import hashlib
+import threading
+from collections import OrderedDict
+import numpy as np
+
+# the disk store is trimmed to this fraction of store_max_bytes so it isn't
+# rescanned on every write once it is full
+STORE_TRIM_TO = 0.9
+
+class ImageCache:
+    '''LRU of decoded images with an optional memory mapped disk store'''
+    def __init__(self, max_bytes=256 << 20, store=None, store_max_bytes=0):
+        self.max_bytes = max_bytes
+        self.store = store
+        self.store_max_bytes = store_max_bytes
+        self.bytes = 0
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self._store_bytes = 0
+        self._lru = OrderedDict()
+        self._lock = threading.Lock()
+        if store:
+            os.makedirs(store, exist_ok=True)
+            self.trim_store()
+
+    @staticmethod
+    def key(filename, width):
+        '''the cache key of filename scaled to width, None if it can't be
+        stat'ed'''
+        try:
+            st = os.stat(filename)
+        except OSError:
+            return None
+        return (os.path.abspath(filename), st.st_mtime_ns, st.st_size, width)
+
+    def __store_path(self, key):
+        '''the .npy file of key in the disk store'''
+        name = hashlib.blake2b(repr(key).encode(), digest_size=16).hexdigest()
+        return os.path.join(self.store, name + '.npy')
+
+    def get(self, filename, width):
+        '''the cached image of filename at width, None if it isn't cached'''
+        key = self.key(filename, width)
+        if key is None:
+            return None
+        return self.__get(key)
+
+    def __get(self, key):
+        '''look key up in memory, then in the disk store'''
+        with self._lock:
+            img = self._lru.get(key)
+            if img is not None:
+                self._lru.move_to_end(key)
+                self.hits += 1
+                return img
+        if self.store:
+            try:
+                img = np.load(self.__store_path(key), mmap_mode='r')
+            except (OSError, ValueError):
+                img = None
+            if img is not None:
+                with self._lock:
+                    self.disk_hits += 1
+                self.__remember(key, img)
+                return img
+        return None
+
+    def put(self, filename, width, img):
+        '''cache img as the image of filename at width'''
+        key = self.key(filename, width)
+        if key is not None and img is not None:
+            self.__put(key, img)
+
+    def __put(self, key, img):
+        '''remember img and save it in the disk store'''
+        self.__remember(key, img)
+        if self.store:
+            path = self.__store_path(key)
+            tmpname = '%s.%d.%d.tmp' % (path, os.getpid(), threading.get_ident())
+            try:
+                with open(tmpname, 'wb') as f:
+                    np.save(f, np.ascontiguousarray(img))
+                    size = f.tell()
+                os.replace(tmpname, path)
+            except OSError:
+                if os.path.exists(tmpname):
+                    os.remove(tmpname)
+                return
+            with self._lock:
+                self._store_bytes += size
+                full = 0 < self.store_max_bytes < self._store_bytes
+            if full:
+                self.trim_store()
+
+    def __remember(self, key, img):
+        '''add img to the LRU dropping the least recently used images to
+        stay within max_bytes'''
+        if img.nbytes > self.max_bytes:
+            return
+        with self._lock:
+            old = self._lru.pop(key, None)
+            if old is not None:
+                self.bytes -= old.nbytes
+            self._lru[key] = img
+            self.bytes += img.nbytes
+            while self.bytes > self.max_bytes:
+                _, dropped = self._lru.popitem(last=False)
+                self.bytes -= dropped.nbytes
+
+    def load(self, filename, width, loader):
+        '''the image of filename at width from the cache, or loader(filename,
+        width) which is then cached.  None results are not cached'''
+        key = self.key(filename, width)
+        if key is not None:
+            img = self.__get(key)
+            if img is not None:
+                return img
+        with self._lock:
+            self.misses += 1
+        img = loader(filename, width)
+        if key is not None and img is not None:
+            self.__put(key, img)
+        return img
+
+    def trim_store(self):
+        '''if the disk store holds more than store_max_bytes (and that is
+        set) delete its oldest files until it is down to STORE_TRIM_TO of it.
+        the running total put() keeps is reset to what is on disk, other
+        processes may be writing to the store too'''
+        if not self.store or self.store_max_bytes <= 0:
+            return
+        entries = []
+        with os.scandir(self.store) as it:
+            for entry in it:
+                if entry.name.endswith('.npy'):
+                    st = entry.stat()
+                    entries.append((st.st_mtime, st.st_size, entry.path))
+        total = sum(size for _, size, _ in entries)
+        if total > self.store_max_bytes:
+            for _, size, path in sorted(entries):
+                if total <= self.store_max_bytes * STORE_TRIM_TO:
+                    break
+                try:
+                    os.remove(path)
+                    total -= size
+                except OSError:
+                    pass
+        with self._lock:
+            self._store_bytes = total
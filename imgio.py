@@ -0,0 +1,238 @@
+'''Image file helpers shared by the scripts.
+#
+# jpeg_header(filename) walks the JPEG markers up to the SOF (start of
+# frame) segment and returns the image dimensions without decoding any
+# pixel data, it only reads the first few KB of the file.
+#
+# cv2.imread rotates images by their EXIF orientation tag, so the width and
+# height returned are swapped for orientations that rotate by 90 degrees,
+# matching what img.shape would be after a full decode.
+#
+#  hdr = jpeg_header('dog.jpg')
+#  if hdr is not None and hdr.width <= 800:
+#      ... no need to decode it
+#
+# image_size(filename) returns (width, height) from the header, only
+# falling back to decoding the whole image for files the probe can't parse.
+#
+# imread_scaled(filename, (width, height)) loads an image straight to the
+# size asked for.  When shrinking a JPEG by 2x or more it asks the decoder
+# for a 1/2, 1/4 or 1/8 scale decode (the largest that is still at least
+# the target size) and only resizes the remainder, which is much faster
+# and uses far less memory than decoding phone camera images at full size.
+#
+# jpeg_header_bytes(data) and imdecode_scaled(data, dim) do the same for
+# JPEG data already in memory, e.g. a record of a packset.
+#'''
+import struct
+from collections import namedtuple
+import numpy as np
+import cv2
+
+# mcu_width/mcu_height is the size in pixels of the MCU (minimum coded unit,
+# the block the DCT data is stored in) from the component sampling factors
+JpegHeader = namedtuple('JpegHeader', ['width', 'height', 'orientation',
+                                       'mcu_width', 'mcu_height'])
+
+# frame header markers, everything in C0..CF except DHT (C4), JPG (C8), DAC (CC)
+SOF_MARKERS = {0xC0, 0xC1, 0xC2, 0xC3, 0xC5, 0xC6, 0xC7,
+               0xC9, 0xCA, 0xCB, 0xCD, 0xCE, 0xCF}
+# markers that stand alone without a length field
+STANDALONE_MARKERS = {0x01, 0xD0, 0xD1, 0xD2, 0xD3, 0xD4, 0xD5, 0xD6, 0xD7, 0xD8}
+EXIF_ORIENTATION_TAG = 0x0112
+# reduced resolution decode modes, largest reduction first
+REDUCED_MODES = ((8, cv2.IMREAD_REDUCED_COLOR_8),
+                 (4, cv2.IMREAD_REDUCED_COLOR_4),
+                 (2, cv2.IMREAD_REDUCED_COLOR_2))
+
+
+def exif_orientation(app1):
+    '''return the orientation (1..8) from the payload of an APP1 segment,
+    1 (normal) if it is not EXIF or has no orientation tag'''
+    if len(app1) < 14 or app1[:6] != b'Exif\x00\x00':
+        return 1
+    tiff = app1[6:]
+    if tiff[:2] == b'II':
+        endian = '<'
+    elif tiff[:2] == b'MM':
+        endian = '>'
+    else:
+        return 1
+    try:
+        (ifd,) = struct.unpack(endian + 'I', tiff[4:8])
+        (count,) = struct.unpack(endian + 'H', tiff[ifd:ifd + 2])
+        for i in range(count):
+            entry = ifd + 2 + i * 12
+            tag, _, _ = struct.unpack(endian + 'HHI', tiff[entry:entry + 8])
+            if tag == EXIF_ORIENTATION_TAG:
+                (value,) = struct.unpack(endian + 'H', tiff[entry + 8:entry + 10])
+                return value if 1 <= value <= 8 else 1
+    except struct.error:
+        pass
+    return 1
+
+
+def jpeg_header(filename):
+    '''Read the markers of the JPEG file up to the frame header and return a
+    JpegHeader(width, height, orientation, mcu_width, mcu_height), or None if the file is not a JPEG
+    or the header could not be parsed (let cv2 deal with those)'''
+    try:
+        with open(filename, 'rb') as f:
+            return read_jpeg_header(f)
+    except OSError:
+        return None
+
+
+class BufferReader:
+    '''the read() and seek() of a binary file over a buffer, read() returns
+    memoryview slices of it so nothing is copied'''
+    def __init__(self, data):
+        self.data = memoryview(data)
+        self.pos = 0
+
+    def read(self, size):
+        '''the next size bytes (fewer at the end) as a memoryview'''
+        chunk = self.data[self.pos:self.pos + size]
+        self.pos += len(chunk)
+        return chunk
+
+    def seek(self, offset, whence=0):
+        '''move to offset, from the current position if whence is 1'''
+        self.pos = self.pos + offset if whence == 1 else offset
+
+
+def jpeg_header_bytes(data):
+    '''jpeg_header of JPEG data in memory (bytes, memoryview or mmap slice),
+    the markers are read in place without copying the data'''
+    return read_jpeg_header(BufferReader(data))
+
+
+def next_marker(f):
+    '''the next marker byte of f after an 0xff, None at the end of the data'''
+    byte = f.read(1)
+    while byte and byte != b'\xff':
+        byte = f.read(1)
+    # any number of 0xff fill bytes can precede a marker
+    while byte == b'\xff':
+        byte = f.read(1)
+    return byte[0] if byte else None
+
+
+def next_segment(f):
+    '''(marker, payload size) of the next marker segment of f, skipping
+    standalone markers.  None at the end of the data, at a start of scan or
+    end of image, or if the length is broken'''
+    marker = next_marker(f)
+    while marker in STANDALONE_MARKERS or marker == 0x00:
+        marker = next_marker(f)
+    if marker is None or marker in (0xD9, 0xDA):
+        # end of image or start of scan before any frame header
+        return None
+    length = f.read(2)
+    if len(length) != 2:
+        return None
+    (length,) = struct.unpack('>H', length)
+    return (marker, length - 2) if length >= 2 else None
+
+
+def frame_header(frame, orientation=1):
+    '''the JpegHeader of the payload of a frame header (SOF) segment, None
+    if it is too short or leaves the height to a later DNL marker'''
+    if len(frame) < 6:
+        return None
+    _, height, width, ncomp = struct.unpack('>BHHB', frame[:6])
+    if height == 0 or width == 0:
+        return None
+    # each component is id, sampling factors (h << 4 | v), table
+    sampling = frame[7:6 + 3 * ncomp:3]
+    mcu_width = 8 * max([b >> 4 for b in sampling] or [1])
+    mcu_height = 8 * max([b & 0x0f for b in sampling] or [1])
+    if orientation >= 5:
+        width, height = height, width
+        mcu_width, mcu_height = mcu_height, mcu_width
+    return JpegHeader(width, height, orientation, mcu_width, mcu_height)
+
+
+def read_jpeg_header(f):
+    '''jpeg_header of the JPEG read from the binary file object f (or a
+    BufferReader), what f.read() returns only has to compare and unpack
+    like bytes'''
+    if f.read(2) != b'\xff\xd8':
+        return None
+    orientation = 1
+    segment = next_segment(f)
+    while segment is not None:
+        marker, size = segment
+        if marker in SOF_MARKERS:
+            return frame_header(f.read(size), orientation)
+        if marker == 0xE1 and orientation == 1:
+            orientation = exif_orientation(f.read(size))
+        else:
+            f.seek(size, 1)
+        segment = next_segment(f)
+    return None
+
+
+def image_size(filename):
+    '''return the (width, height) of the image in filename as cv2.imread would
+    load it, or None if it can't be read.  Only the JPEG header is read
+    unless it is some other format or an odd JPEG the probe can't parse'''
+    hdr = jpeg_header(filename)
+    if hdr is not None:
+        return (hdr.width, hdr.height)
+    img = cv2.imread(filename)
+    if img is None:
+        return None
+    return (img.shape[1], img.shape[0])
+
+
+def reduced_mode(src, dim):
+    '''return the (factor, imread flag) of the largest power of two reduction
+    of the src (width, height) that is still at least dim in both directions'''
+    for factor, mode in REDUCED_MODES:
+        if src[0] // factor >= dim[0] and src[1] // factor >= dim[1]:
+            return factor, mode
+    return 1, cv2.IMREAD_COLOR
+
+
+def imread_scaled(filename, dim, hdr=None):
+    '''Load the image in filename resized to dim (width, height), decoding
+    at a reduced resolution when the JPEG header shows it is much bigger than
+    dim. If height is None it is set from width preserving the aspect ratio.
+    hdr is the jpeg_header of filename if the caller already has it.
+    Returns None if the image can not be read, like cv2.imread'''
+    if hdr is None:
+        hdr = jpeg_header(filename)
+    return decode_scaled(lambda mode: cv2.imread(filename, mode), dim, hdr)
+
+
+def imdecode_scaled(data, dim, hdr=None):
+    '''imread_scaled of image data in memory, anything np.frombuffer takes
+    so a slice of an mmap is decoded in place without a copy'''
+    if hdr is None:
+        hdr = jpeg_header_bytes(data)
+    buf = np.frombuffer(data, dtype=np.uint8)
+    return decode_scaled(lambda mode: cv2.imdecode(buf, mode), dim, hdr)
+
+
+def decode_scaled(decode, dim, hdr):
+    '''decode(imread flag) resized to dim, with a reduced resolution flag
+    when hdr (None if not a JPEG) shows the image is much bigger than dim'''
+    if hdr is None:
+        img = decode(cv2.IMREAD_COLOR)
+        if img is None:
+            return None
+        src = (img.shape[1], img.shape[0])
+    else:
+        src = (hdr.width, hdr.height)
+    (width, height) = dim
+    if height is None:
+        height = int(src[1] * (width / float(src[0])))
+    if hdr is not None:
+        _, mode = reduced_mode(src, (width, height))
+        img = decode(mode)
+        if img is None:
+            return None
+    if (img.shape[1], img.shape[0]) != (width, height):
+        img = cv2.resize(img, (width, height))
+    return img
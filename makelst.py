@@ -14,95 +14,259 @@ https://github.com/zhreshold/mxnet-ssd/issues/163
 If the txt file has multiple labels, they will all be read, converted, and emitted in a
 line in the lst file (its possible that they should be sorted by classid in the future)
 
+Files ending .jpg or .jpeg (any case) are processed, --recursive takes in
+subdirectories too with the path relative to imagedir in the LST.
+
 The order of the output is determined by the directory listing - if you want to
 randomize the order, then use something like the unix shuf command.
 
 if you have alot of lables (10+ make sure to set the label_width really
 large (like 500 in the hyperparameters))
+
+With --rec PREFIX it also writes PREFIX.rec and PREFIX.idx directly so there
+is no need to run im2rec.py.  The original JPEG bytes are stored as they are
+(like im2rec.py --pass-through) with the same label header as the LST line.
+Files are read by a pool of --jobs threads and written in LST order, each
+LST line is printed once its record is written, and a jpg that can't be
+read is left out of both (the indexes stay consecutive).  --shards N
+splits the records round robin over N rec/idx pairs named
+PREFIX-00000-of-0000N.rec/.idx for distributed training readers.
+
+--mirror xyz (with --rec) also adds the -xX, -yY, -zZ mirrors of every
+image, flipped on the fly by mirrorset.MirrorDataset, so the mirror files
+never have to be written to disk with mirrorxyz.py.
+
+The functions can be imported too, makelst.main(argv) runs the command line
+with a list of arguments and lst_lines() yields the LST lines of a set of
+entries (see scan_entries and mirror_entries) without printing them.
 '''
 import sys
 import os
-import fnmatch
 import argparse
-import cv2
+from collections import deque
+from functools import partial
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
+import numpy as np
+import dirscan
+import imgio
+import yololabel
+
+# labels are parsed at full precision so the LST coordinates are rounded
+# from the values in the txt files, not from float32 approximations
+LABEL_DTYPE = np.float64
 
-def parse_args():
+def parse_args(argv=None):
     '''Load args...'''
     description = '''Generate an LST format to standard out from JPG files and
     label files in the yolo format for processing by im2rec.py\n'''
     parser = argparse.ArgumentParser(description)
     parser.add_argument('--imagedir', dest='imagedir', required=True,
                         help='process jpg/txt files in imagedir')
-    args = parser.parse_args()
+    parser.add_argument('--with-size', dest='with_size', action='store_true',
+                        help='include the image width and height in the header of each line')
+    parser.add_argument('--rec', dest='rec', type=str,
+                        help='also write PREFIX.rec/PREFIX.idx record files directly')
+    parser.add_argument('--shards', dest='shards', type=int, default=1,
+                        help='number of rec/idx files to split the records over; default 1')
+    parser.add_argument('--jobs', dest='jobs', type=int, default=os.cpu_count(),
+                        help='threads reading and packing records; default number of cpus')
+    parser.add_argument('--mirror', dest='mirror', type=str,
+                        help='''with --rec add virtual mirrors of every image around these
+                                axes, e.g. xyz''')
+    parser.add_argument('--recursive', dest='recursive', action='store_true',
+                        help='also process jpg/txt files in subdirectories of imagedir')
+    args = parser.parse_args(argv)
     return args
 
-def processfile(srcjpg):
+def processfile(srcjpg, labels=None):
     '''
-    Read the jpg file specified
+    Read the dimensions of the jpg file specified (just its header)
     Read its associated label (.txt) file from the same directory/basename
     ending with .txt (if it exists) If the txt file does not exist, or has
     no labels then a single label of [-1,-1,-1,-1,-1] will be emitted.
+    labels can pass in the (N, 5) array of the label file if it has already
+    been loaded (see yololabel.load_all).
     Produce the w, h, and a list containing the 0..n class id, and convert the
     center/extents of the label to a bounding rectangle
     Return None if it can't read the jpg file'''
-    img = cv2.imread(srcjpg)
-    if img is None:
+    size = imgio.image_size(srcjpg)
+    if size is None:
         print(sys.argv[0], "Skipping image: failed reading", srcjpg, file=sys.stderr)
         return None
 
-    height, width, _ = img.shape
-    txtfile = srcjpg[:-4] + ".txt"
+    width, height = size
+    if labels is None:
+        labels = yololabel.load(dirscan.label_path(srcjpg), LABEL_DTYPE)
+    if labels is None or not labels.size:
+        # No labels for this image, but im2rec expects at least one, so pass this
+        return True, width, height, [["-1.", "-1.", "-1.", "-1.", "-1."]]
+    # python's round on float64 like the per line parser did, np.round
+    # differs in the last digit now and then
+    corners = yololabel.to_corners(labels.astype(LABEL_DTYPE)).tolist()
+    return True, width, height, [[str(row[0])] + [str(round(v, 5)) for v in row[1:]]
+                                 for row in corners]
+
+def ordered_map(pool, func, items, depth):
+    '''like pool.map but with at most depth items in flight, so results that
+    hold whole files don't pile up in memory ahead of the consumer'''
+    items = iter(items)
+    pending = deque(pool.submit(func, item) for item in islice(items, depth))
+    while pending:
+        future = pending.popleft()
+        item = next(items, None)
+        if item is not None:
+            pending.append(pool.submit(func, item))
+        yield future.result()
+
+def read_file(path):
+    '''the bytes of the file at path'''
+    with open(path, 'rb') as f:
+        return f.read()
+
+def read_item(item):
+    '''(lstline, jpg bytes) of an (lstline, read) item, the bytes are None
+    if the jpg can't be read'''
+    lstline, read = item
+    try:
+        return lstline, read()
+    except OSError:
+        return lstline, None
+
+def pack_record(lstline, jpg):
+    '''pack the jpg bytes with the label and index of lstline into a
+    recordio record'''
+    from mxnet import recordio
+    # like im2rec.py every field between the index and the file name is the label
+    label = np.array([float(x) for x in lstline[1:-1]], dtype=np.float32)
+    return recordio.pack(recordio.IRHeader(0, label, int(lstline[0]), 0), jpg)
+
+def shard_names(prefix, shards):
+    '''the (idx, rec) file names of each shard'''
+    if shards == 1:
+        return [(prefix + '.idx', prefix + '.rec')]
+    return [('%s-%05d-of-%05d.idx' % (prefix, k, shards),
+             '%s-%05d-of-%05d.rec' % (prefix, k, shards)) for k in range(shards)]
+
+def write_records(prefix, items, shards=1, jobs=4):
+    '''pack the (lstline, read) items into recordio files and yield the
+    lstline of each record once it has been written.  jpg files that can't
+    be read are skipped and the records renumbered so the LST index always
+    matches the idx key, record i goes into shard i % shards'''
+    from mxnet import recordio
+    writers = [recordio.MXIndexedRecordIO(idx, rec, 'w')
+               for idx, rec in shard_names(prefix, shards)]
+    count = 0
     try:
-        # if it exists, process the label box dimensions
-        labels = []
-        with open(txtfile, "r") as f:
-            lines = f.readlines()
-            for l in lines:
-                s = l.split()
-                if len(s) != 5:
+        with ThreadPoolExecutor(max_workers=max(1, jobs)) as pool:
+            for lstline, jpg in ordered_map(pool, read_item, items, 4 * max(1, jobs)):
+                if jpg is None:
+                    print(sys.argv[0], "Skipping record: failed reading", lstline[-1],
+                          file=sys.stderr)
                     continue
-                xmin = round(float(s[1]) - float(s[3])/2, 5)
-                ymin = round(float(s[2]) - float(s[4])/2, 5)
-                xmax = round(float(s[1]) + float(s[3])/2, 5)
-                ymax = round(float(s[2]) + float(s[4])/2, 5)
-                labels.append([str(float(s[0])), str(xmin), str(ymin), str(xmax), str(ymax)])
-    except IOError:
-        pass
-    if not labels:
-        # No labels for this image, but im2rec expects at least one, so pass this
-        labels.append(["-1.", "-1.", "-1.", "-1.", "-1."])
-    return True, width, height, labels
+                lstline = [str(count)] + lstline[1:]
+                writers[count % shards].write_idx(count, pack_record(lstline, jpg))
+                count += 1
+                yield lstline
+    finally:
+        for writer in writers:
+            writer.close()
+
+def scan_entries(imagedir, recursive=False, chunk=1024):
+    '''yield (jpg path, name relative to imagedir, labels, read jpg bytes) for
+    each jpg file as imagedir is scanned, the label files of each chunk of
+    files are read together'''
+    files = dirscan.scan(imagedir, recursive=recursive)
+    while True:
+        entries = list(islice(files, chunk))
+        if not entries:
+            return
+        labels, offsets = yololabel.load_all([dirscan.label_path(e.path) for e in entries],
+                                             dtype=LABEL_DTYPE)
+        for i, e in enumerate(entries):
+            yield (e.path, e.relpath, labels[offsets[i]:offsets[i + 1]],
+                   partial(read_file, e.path))
+
+def mirror_entries(imagedir, axes, recursive=False):
+    '''yield (source jpg path, name of the mirror, labels, read jpg bytes)
+    for each image of imagedir and its virtual mirrors around axes'''
+    import mirrorset
+    dataset = mirrorset.MirrorDataset(imagedir, axes, recursive=recursive)
+    for i in range(len(dataset)):
+        labels = dataset.labels(i, LABEL_DTYPE)
+        yield (dataset.source(i), dataset.name(i),
+               yololabel.empty(LABEL_DTYPE) if labels is None else labels,
+               partial(dataset.jpeg, i))
+
+def lst_lines(entries, with_size=False):
+    '''yield (lstline, read) for the (source jpg, name in the lst, labels,
+    read jpg bytes) entries, lstline is the list of fields of the LST line.
+    entries whose jpg can't be read are skipped'''
+    count = 0
+    for src_jpg, file, file_labels, read in entries:
+        # read the dimensions of the source jpg file, a mirror has the same
+        result = processfile(src_jpg, file_labels)
+        if result is None:
+            continue
+        success, width, height, labels = result
+        label_s = [item for sublist in labels for item in sublist]
+
+        # this line format is documented https://mxnet.incubator.apache.org/api/python/
+        # image/image.html#image-iterator-for-object-detection
+        # Index, A  B  [extra header]  [(object0), (object1), ... (objectN)] file
+        # Where A is the width (number of fields including itself) of header (2 which
+        # are A(this number), and B (the number of fields in a single label)),
+        # B is the number of fields in a label. for this program a label has 5 fields
+        # classid, xmin, ymin, xmax, ymax
+        # with --with-size the image width and height are added as the extra
+        # header, so A goes up to 4 and they follow B (readers expect B to be
+        # the second field)
+        if with_size:
+            header = [str(4), str(5), str(width), str(height)]
+        else:
+            header = [str(2), str(5)]
+        yield [str(count)] + header + label_s + [file], read
+        if success:
+            count += 1
 
 #
 #  Main section that plucks and validates the args, and processes the file list
 #
-ARGS = parse_args()
-COUNT = 0
-# validate the dir path and scan for jpg files
-try:
-    DIRLIST = fnmatch.filter(os.listdir(ARGS.imagedir), "*.jpg")
-except os.error:
-    print(sys.argv[0], ": exception accessing", ARGS.imagedir, file=sys.stderr)
-    sys.exit()
-
-# process eash file in the dirlist
-for file in DIRLIST:
-    # form the full path to the source jpg file, read it and get the dimensions
-    src_jpg = os.path.join(ARGS.imagedir, file)
-    success, _, _, labels = processfile(src_jpg)
-    label_s = [item for sublist in labels for item in sublist]
-
-    # this line format is documented https://mxnet.incubator.apache.org/api/python/
-    # image/image.html#image-iterator-for-object-detection
-    # Index, A  B  [extra header]  [(object0), (object1), ... (objectN)] file
-    # Where A is the width (number of fields including itself) of header (2 which
-    # are A(this number), and B (the number of fields in a single label)),
-    # B is the number of fields in a label. for this program a label has 5 fields
-    # classid, xmin, ymin, xmax, ymax
-    # if you wanted the image width and height in the header, just bump the
-    # A (str(2)) value up to str(4), and put str(width), str(height) before B(str(5))
-    # i've not found anything that required width/height so leaving it out.
-    lstline = [str(COUNT), str(2), str(5)] + label_s + [file]
-    print('\t'.join(lstline))
-    if success:
-        COUNT += 1
+def main(argv=None):
+    '''write the LST (and rec) files the command line (or argv) specifies'''
+    args = parse_args(argv)
+    # validate the dir path
+    if not os.path.isdir(args.imagedir):
+        print(sys.argv[0], ": exception accessing", args.imagedir, file=sys.stderr)
+        sys.exit()
+
+    if args.shards < 1:
+        print(sys.argv[0], ": --shards must be at least 1", file=sys.stderr)
+        sys.exit()
+
+    if args.mirror and not args.rec:
+        print(sys.argv[0], ": --mirror needs --rec, the mirror files don't exist for an LST",
+              file=sys.stderr)
+        sys.exit()
+
+    if args.mirror:
+        entries = mirror_entries(args.imagedir, args.mirror, args.recursive)
+    else:
+        entries = scan_entries(args.imagedir, args.recursive)
+
+    # process eash file in the dirlist, with --rec each LST line is only
+    # printed once its record has been written
+    if not args.rec:
+        for lstline, _ in lst_lines(entries, args.with_size):
+            print('\t'.join(lstline))
+        return
+
+    written = 0
+    for lstline in write_records(args.rec, lst_lines(entries, args.with_size),
+                                 args.shards, args.jobs):
+        print('\t'.join(lstline))
+        written += 1
+    print(sys.argv[0], ": wrote", written, "records to", args.rec, file=sys.stderr)
+
+if __name__ == '__main__':
+    main()
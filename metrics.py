@@ -0,0 +1,272 @@
+'''Lightweight stage timers, gauges and counters with Prometheus export.
+#
+# Nothing is recorded until enable() is called, until then timer() hands
+# out a shared do nothing context manager and gauge()/count() return
+# straight away, so instrumented code costs a function call per stage.
+#
+# Stage timings go into fixed bucket histograms (buckets sqrt(2) apart from
+# 50us to about 3 minutes) so memory is constant however long a process
+# runs, and p50/p95/p99 are estimated from the buckets.
+#
+#  metrics.enable(prometheus='/var/lib/node_exporter/detectimg.prom',
+#                 port=9101, log_interval=60)
+#  with metrics.timer('forward'):
+#      model.forward(batch)
+#  metrics.gauge('prefetch_queue', len(pending))
+#  metrics.count('frames_dropped')
+#  metrics.close()          # final export
+#
+# Exports:
+#   prometheus_text()  the Prometheus text format of everything recorded,
+#                      written atomically to the prometheus file every
+#                      log_interval seconds (and on close()), and served
+#                      at http://127.0.0.1:port/metrics with a port
+#   json_line()        one line of JSON with the count, mean, p50, p95
+#                      and p99 of each stage and the gauge/counter values,
+#                      printed to stderr every log_interval seconds
+#'''
+import os
+import sys
+import json
+import math
+import time
+import threading
+from bisect import bisect_left
+
+PREFIX = 'imageutil'
+# upper bounds of the histogram buckets in seconds
+BUCKETS = [0.00005 * math.sqrt(2) ** i for i in range(44)]
+
+_enabled = False
+_lock = threading.Lock()
+_histograms = {}
+_gauges = {}
+_counters = {}
+_reporter = None
+_server = None
+
+
+class Histogram:
+    '''Fixed bucket histogram of durations in seconds'''
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, seconds):
+        '''add a duration'''
+        self.counts[bisect_left(BUCKETS, seconds)] += 1
+        self.count += 1
+        self.sum += seconds
+
+    def percentile(self, q):
+        '''estimate of the q (0..100) percentile, interpolated inside the
+        bucket it falls in'''
+        if not self.count:
+            return None
+        rank = q / 100.0 * self.count
+        seen = 0
+        for i, n in enumerate(self.counts):
+            if n and seen + n >= rank:
+                lo = BUCKETS[i - 1] if i > 0 else 0.0
+                hi = BUCKETS[i] if i < len(BUCKETS) else BUCKETS[-1] * 2
+                return lo + (hi - lo) * (rank - seen) / n
+            seen += n
+        return BUCKETS[-1]
+
+
+class _Timer:
+    '''context manager adding the time spent inside it to a histogram'''
+    __slots__ = ('name', 'start')
+
+    def __init__(self, name):
+        self.name = name
+        self.start = 0.0
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        observe(self.name, time.perf_counter() - self.start)
+        return False
+
+
+class _NullTimer:
+    '''timer() while metrics are disabled'''
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+_NULL_TIMER = _NullTimer()
+
+
+def enabled():
+    '''True once enable() has been called'''
+    return _enabled
+
+
+def timer(stage):
+    '''a context manager timing the code inside it as stage'''
+    if not _enabled:
+        return _NULL_TIMER
+    return _Timer(stage)
+
+
+def observe(stage, seconds):
+    '''record a duration of stage measured some other way'''
+    if not _enabled:
+        return
+    with _lock:
+        hist = _histograms.get(stage)
+        if hist is None:
+            hist = _histograms[stage] = Histogram()
+        hist.observe(seconds)
+
+
+def gauge(name, value):
+    '''set the current value of name, e.g. a queue depth'''
+    if _enabled:
+        _gauges[name] = value
+
+
+def count(name, n=1):
+    '''add n to the counter name'''
+    if not _enabled:
+        return
+    with _lock:
+        _counters[name] = _counters.get(name, 0) + n
+
+
+def summary():
+    '''{stage: {count, mean, p50, p95, p99}} in seconds, plus the gauges and
+    counters'''
+    with _lock:
+        stages = {stage: {'count': h.count, 'mean': h.sum / h.count if h.count else None,
+                          'p50': h.percentile(50), 'p95': h.percentile(95),
+                          'p99': h.percentile(99)}
+                  for stage, h in _histograms.items()}
+        return {'stages': stages, 'gauges': dict(_gauges), 'counters': dict(_counters)}
+
+
+def json_line():
+    '''the summary as a single line of JSON with a timestamp'''
+    line = summary()
+    line['time'] = time.strftime('%Y-%m-%dT%H:%M:%S')
+    return json.dumps(line, sort_keys=True)
+
+
+def prometheus_text():
+    '''everything recorded in the Prometheus text exposition format'''
+    lines = []
+    with _lock:
+        if _histograms:
+            name = PREFIX + '_stage_seconds'
+            lines.append('# HELP %s Time spent in each processing stage.' % name)
+            lines.append('# TYPE %s histogram' % name)
+            for stage, h in sorted(_histograms.items()):
+                cumulative = 0
+                for bound, n in zip(BUCKETS + [float('inf')], h.counts):
+                    cumulative += n
+                    le = '+Inf' if math.isinf(bound) else '%.6g' % bound
+                    lines.append('%s_bucket{stage="%s",le="%s"} %d' %
+                                 (name, stage, le, cumulative))
+                lines.append('%s_sum{stage="%s"} %.9g' % (name, stage, h.sum))
+                lines.append('%s_count{stage="%s"} %d' % (name, stage, h.count))
+        for gname, value in sorted(_gauges.items()):
+            lines.append('# TYPE %s_%s gauge' % (PREFIX, gname))
+            lines.append('%s_%s %.9g' % (PREFIX, gname, value))
+        for cname, value in sorted(_counters.items()):
+            lines.append('# TYPE %s_%s_total counter' % (PREFIX, cname))
+            lines.append('%s_%s_total %.9g' % (PREFIX, cname, value))
+    return '\n'.join(lines) + '\n'
+
+
+def write_prometheus(filename):
+    '''write prometheus_text() to filename atomically, for the node
+    exporter textfile collector'''
+    tmpname = filename + '.tmp'
+    with open(tmpname, 'w') as f:
+        f.write(prometheus_text())
+    os.replace(tmpname, filename)
+
+
+def _serve(port):
+    '''serve prometheus_text() at /metrics on localhost:port'''
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    class Handler(BaseHTTPRequestHandler):
+        '''GET /metrics'''
+        def do_GET(self):  # pylint: disable=invalid-name
+            if self.path.split('?')[0] != '/metrics':
+                self.send_error(404)
+                return
+            body = prometheus_text().encode()
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(('127.0.0.1', port), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+class _Reporter(threading.Thread):
+    '''writes the prometheus file and the JSON log line every interval'''
+    def __init__(self, interval, prometheus, log):
+        super().__init__(daemon=True)
+        self.interval = interval
+        self.prometheus = prometheus
+        self.log = log
+        self.stop = threading.Event()
+
+    def run(self):
+        '''export every interval until stop is set'''
+        while not self.stop.wait(self.interval):
+            self.report()
+
+    def report(self):
+        '''export once'''
+        if self.prometheus:
+            write_prometheus(self.prometheus)
+        if self.log:
+            print(json_line(), file=sys.stderr, flush=True)
+
+
+def enable(prometheus=None, port=None, log_interval=0):
+    '''start recording.  prometheus is a file to write the Prometheus text
+    to, port serves it over HTTP on localhost and log_interval > 0 prints
+    the JSON line (and rewrites the prometheus file) that often'''
+    global _enabled, _reporter, _server
+    _enabled = True
+    if port:
+        _server = _serve(port)
+    if prometheus or log_interval > 0:
+        _reporter = _Reporter(log_interval if log_interval > 0 else 10, prometheus,
+                              log_interval > 0)
+        _reporter.start()
+
+
+def close():
+    '''final export and stop the reporter and HTTP server'''
+    global _reporter, _server
+    if _reporter is not None:
+        _reporter.stop.set()
+        _reporter.join()
+        _reporter.report()
+        _reporter = None
+    if _server is not None:
+        _server.shutdown()
+        # shutdown only stops serve_forever, the listening socket stays open
+        _server.server_close()
+        _server = None
@@ -0,0 +1,127 @@
+'''Virtual mirror augmentation of a directory of jpg/yolo_mark txt files.
+#
+# Instead of running mirrorxyz.py and storing every mirror on disk,
+# MirrorDataset lists each source jpg plus the -xX, -yY, -zZ mirrors that
+# mirrorxyz.py would have made of it, and flips the image (cv2.flip with
+# the FLIPMAP codes) and its labels (like fliprect) when an item is read.
+# Decoded source images are kept in a small LRU cache so reading all the
+# mirrors of a source only decodes it once.
+#
+#  ds = MirrorDataset('data/train', axes='xyz')
+#  for name, img, labels in ds:          # or ds.shuffled(seed) for training
+#      ...                               # name is e.g. 'img0-yY.jpg'
+#  ds.jpeg(i)                            # encoded bytes, e.g. for a .rec file
+#
+# Files already tagged -xX/-yY/-zZ in the directory are skipped, the same
+# as mirrorxyz.py.
+#'''
+import os
+import random
+import threading
+from collections import OrderedDict
+import numpy as np
+import cv2
+import dirscan
+import yololabel
+from mirrorxyz import FLIPMAP, MIRROR_TAGS
+
+
+class MirrorDataset:
+    '''Source images of imagedir plus their virtual mirrors around axes
+
+    item i is (name, image, labels), image is BGR like cv2.imread and labels
+    the (N, 5) yolo_mark array (None if the source has no label file)'''
+    def __init__(self, imagedir, axes='xyz', cache_size=64, include_source=True,
+                 recursive=False):
+        self.imagedir = imagedir
+        self.cache_size = max(1, cache_size)
+        flips = [(None, None)] if include_source else []
+        for axis in axes.lower():
+            if axis not in FLIPMAP:
+                raise Exception("Invalid axis " + axis)
+            tag = "-" + axis + axis.upper()
+            if (tag, FLIPMAP[axis]) not in flips:
+                flips.append((tag, FLIPMAP[axis]))
+        sources = sorted(e.relpath for e in dirscan.scan(imagedir, recursive=recursive)
+                         if dirscan.stem(e.name)[-3:] not in MIRROR_TAGS)
+        # (source jpg, fliptag, flipxyz), the mirrors of a source follow it so
+        # reading in order only decodes each source once
+        self.items = [(f, tag, flipxyz) for f in sources for tag, flipxyz in flips]
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.items)
+
+    def __getitem__(self, i):
+        return self.name(i), self.image(i), self.labels(i)
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def shuffled(self, seed=None):
+        '''iterate over the items in a random order, for training'''
+        order = list(range(len(self)))
+        random.Random(seed).shuffle(order)
+        for i in order:
+            yield self[i]
+
+    def name(self, i):
+        '''the file name mirrorxyz.py would have given item i'''
+        src, tag, _ = self.items[i]
+        if tag is None:
+            return src
+        return dirscan.stem(src) + tag + os.path.splitext(src)[1]
+
+    def source(self, i):
+        '''path of the source jpg of item i'''
+        return os.path.join(self.imagedir, self.items[i][0])
+
+    def __decoded(self, src):
+        '''the decoded source image, from the LRU cache if it is there'''
+        with self._lock:
+            if src in self._cache:
+                self._cache.move_to_end(src)
+                return self._cache[src]
+        img = cv2.imread(os.path.join(self.imagedir, src))
+        if img is not None:
+            # handed out as the unmirrored item, a caller drawing on it
+            # would change every later mirror of the source
+            img.setflags(write=False)
+        with self._lock:
+            self._cache[src] = img
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+        return img
+
+    def image(self, i):
+        '''the (mirrored) image of item i, None if the source can't be read.
+        the image of a source item is the cached decode and read only, copy
+        it to draw on it'''
+        src, _, flipxyz = self.items[i]
+        img = self.__decoded(src)
+        if img is None or flipxyz is None:
+            return img
+        return cv2.flip(img, flipxyz)
+
+    def labels(self, i, dtype=np.float32):
+        '''the (mirrored) labels of item i, None if the source has none'''
+        src, _, flipxyz = self.items[i]
+        labels = yololabel.load(dirscan.label_path(os.path.join(self.imagedir, src)), dtype)
+        if labels is None or flipxyz is None:
+            return labels
+        return yololabel.flip(labels, flipxyz)
+
+    def jpeg(self, i):
+        '''the JPEG bytes of item i, the source file as it is or the mirror
+        encoded on the fly, None if the source can't be read'''
+        _, tag, _ = self.items[i]
+        if tag is None:
+            with open(self.source(i), 'rb') as f:
+                return f.read()
+        img = self.image(i)
+        if img is None:
+            return None
+        ok, buf = cv2.imencode('.jpg', img)
+        return buf.tobytes() if ok else None
@@ -1,5 +1,5 @@
 #!/usr/bin/python
-'''usage: mirrorxy directory x|y|z
+'''usage: mirrorxy [--lossless] [--jobs JOBS] directory x|y|z [x|y|z ...]
 #
 # read each jpg file, make a mirror image of it flipped on the specified axes
 #  x  -> flip upside down
@@ -20,7 +20,11 @@
 # (mirror left/right and top/bottom)
 #       python mirrorxyz.py data/myfiles z
 #
+# Make all three mirrors in one pass, each image is only decoded once
+#       python mirrorxyz.py data/myfiles x y z
 #
+# files are spread over a pool of --jobs processes, the output is the
+# same (and printed in the same order) whatever the number of jobs
 #
 # if the associated rectangle markup files are found it will read, and flip
 # the coordinations of the rectangle matching the mirrored jpg file will
@@ -32,113 +36,270 @@
 #  test2.txt --> test2-yY.txt
 #  test3.jpg --> test3-zZ.jpg
 #  test3.txt --> test3-zZ.txt
+#
+# --lossless flips the JPEG in the DCT domain with jpegtran (libjpeg-turbo)
+# instead of decoding, flipping and re-encoding it, so there is no
+# generation loss and very little CPU.  That is only exact when the edges
+# the flip moves fall on MCU boundaries: the width must be a multiple of
+# the MCU width for y (left/right), the height a multiple of the MCU
+# height for x (top/bottom), and both for z.  Otherwise jpegtran would
+# have to leave the partial edge blocks in place (or -trim them, changing
+# the size and so the labels), so those files, files with an EXIF
+# rotation, and everything when jpegtran is not installed, fall back to
+# the cv2 pixel flip.
+#
+# --pack takes a packset (see packset.py) instead of a directory, it is
+# rewritten with the mirror records added after each source record (mirror
+# records already in it are made again) without a file per image:
+#       python mirrorxyz.py --pack data/train-pack x y
 #'''
 import sys
 import os
-import fnmatch
+import io
+import shutil
+import argparse
+import subprocess
+from contextlib import redirect_stdout
+from functools import partial
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 import cv2
+import dirscan
+import imgio
+import makelst
+import packset
+import yololabel
 
 FLIPMAP = {'x': 0, 'y' : 1, 'z' : -1}
+# jpegtran transform matching each cv2.flip code
+JPEGTRAN_OPS = {0: ['-flip', 'vertical'], 1: ['-flip', 'horizontal'], -1: ['-rotate', '180']}
+JPEGTRAN = shutil.which('jpegtran')
+MIRROR_TAGS = ["-xX", "-yY", "-zZ"]
+
+def parse_args(argv=None):
+    '''Load args...'''
+    description = '''Make mirror copies of the jpg files (and their yolo label txt
+    files) in directory around one or more axes'''
+    parser = argparse.ArgumentParser(description)
+    parser.add_argument('--lossless', dest='lossless', action='store_true',
+                        help='flip JPEG data with jpegtran when it can be done exactly')
+    parser.add_argument('--jobs', dest='jobs', type=int, default=os.cpu_count(),
+                        help='number of processes mirroring files; default number of cpus')
+    parser.add_argument('--recursive', dest='recursive', action='store_true',
+                        help='also mirror files in subdirectories')
+    parser.add_argument('--pack', dest='pack', action='store_true',
+                        help='directory is a packset to add the mirrors to')
+    parser.add_argument('directory', help='directory of jpg/txt files to mirror')
+    parser.add_argument('axes', nargs='+', help='one or more of x, y, z')
+    return parser.parse_args(argv)
+
+def lossless_ok(hdr, flip_xyz):
+    '''True if the JPEG described by hdr can be flipped exactly in the DCT
+    domain around flip_xyz, every edge the flip moves has to be on an MCU
+    boundary and there can't be an EXIF rotation (cv2 applies it, jpegtran
+    works on the stored orientation)'''
+    if hdr is None or hdr.orientation != 1:
+        return False
+    if flip_xyz in [-1, 1] and hdr.width % hdr.mcu_width:
+        return False
+    if flip_xyz in [-1, 0] and hdr.height % hdr.mcu_height:
+        return False
+    return True
+
+def flipimage_lossless(srcf, destf, flip_xyz):
+    '''Mirror the JPEG around the specified axis with jpegtran without
+    decoding it, -perfect makes jpegtran fail rather than leave partial
+    edge blocks unflipped.  Returns False if it could not be done'''
+    if JPEGTRAN is None or not lossless_ok(imgio.jpeg_header(srcf), flip_xyz):
+        return False
+    cmd = [JPEGTRAN, '-copy', 'all', '-perfect'] + JPEGTRAN_OPS[flip_xyz] + \
+          ['-outfile', destf, srcf]
+    if subprocess.run(cmd, stderr=subprocess.DEVNULL, check=False).returncode != 0:
+        return False
+    print("Mirrored (lossless) ", srcf, " to ", destf)
+    return True
+
+def flipjpeg_lossless(jpg, flip_xyz):
+    '''flipimage_lossless of JPEG data in memory, jpegtran reads it from
+    stdin.  Returns the mirrored JPEG bytes or None if it could not be done'''
+    if JPEGTRAN is None or not lossless_ok(imgio.jpeg_header_bytes(jpg), flip_xyz):
+        return None
+    cmd = [JPEGTRAN, '-copy', 'all', '-perfect'] + JPEGTRAN_OPS[flip_xyz]
+    done = subprocess.run(cmd, input=jpg, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+                          check=False)
+    if done.returncode != 0 or not done.stdout:
+        return None
+    return done.stdout
 
 #
 # using cv2 flip the source image around the specified axes
 #  -1 (xy), 0=x, +1=y
 # save into a new file specified by dest
 #
-def flipimage(srcf, destf, flip_xyz):
-    '''Mirror the image around the specified axis, and save as new file'''
-    img = cv2.imread(srcf)
-    if img is None:
-        print("Failed", srcf)
-        return None
-    flipped = cv2.flip(img, flip_xyz)
-    cv2.imwrite(destf, flipped)
-    print("Mirrored ", srcf, " to ", destf)
-    return True
-
+def flipimage(srcf, destf, flip_xyz, lossless=False):
+    '''Mirror the image around the specified axis, and save as new file,
+    if lossless try flipping the JPEG data first'''
+    return flipimages(srcf, [(destf, flip_xyz)], lossless)
 
 def fliprect(srctxtfile, mirror_txt_file, flipxyz):
     '''if the srctxtfile exists, flip the center of the rectangles specified
        in the srctxtfile, around the axes specified by flipxyz, and saved
        into mirror_txt_file '''
-    try:
-        # if it exists we are going to adjust the x coordinate of the
-        # centroid to sync with the mirror image
-        with open(srctxtfile, "r") as f:
-            lines = f.readlines()
-            linesout = []
-            # for each line adjust the centroid x coordinate to match the
-            # mirror image s[1] is the x corrd, s[2] is the y coord
-            for l in lines:
-                s = l.split()
-                if len(s) != 5:
-                    continue
-                    # if flipxyz is 0, (top to bottomn flip of rectangle)
-                    # if flipxyz is 1,  (left to right flip of rectangle)
-                    # if flipxyz is 2, then just adjust x,y coord (do both)
-                if flipxyz in [-1, 0]:
-                    s[2] = str(round(1.0 - float(s[2]), 6))
-                if flipxyz in [-1, 1]:
-                    s[1] = str(round(1.0 - float(s[1]), 6))
-                linesout.append(s)
-        # make the txt file for the mirror destination image matching the
-        # mirror file name
+    return fliprects(srctxtfile, [(mirror_txt_file, flipxyz)])
+
+def flipimages(srcf, dests, lossless=False):
+    '''Mirror the image once per (destf, flip_xyz) in dests, the source is
+    decoded at most once however many mirrors are made'''
+    img = None
+    ok = True
+    for destf, flip_xyz in dests:
+        if lossless and flipimage_lossless(srcf, destf, flip_xyz):
+            continue
+        if img is None:
+            img = cv2.imread(srcf)
+            if img is None:
+                print("Failed", srcf)
+                return None
+        ok = cv2.imwrite(destf, cv2.flip(img, flip_xyz)) and ok
+        print("Mirrored ", srcf, " to ", destf)
+    return ok
+
+def fliprects(srctxtfile, dests):
+    '''fliprect once per (mirror_txt_file, flipxyz) in dests, reading
+    srctxtfile only once'''
+    labels = yololabel.load(srctxtfile)
+    if labels is None:
+        print("Warning: Bounding rectangle file does not exist: ", srctxtfile)
+        return True
+    # make the txt file for each mirror destination image matching the
+    # mirror file name
+    ok = True
+    for mirror_txt_file, flipxyz in dests:
         print("Saving mirror rectangle file:", mirror_txt_file)
-        try:
-            outfile = open(mirror_txt_file, "w")
-            for l in linesout:
-                outfile.write(" ".join(l)+"\n\r")
-                outfile.close()
-        except IOError:
+        if not yololabel.save(mirror_txt_file, yololabel.flip(labels, flipxyz)):
             print("Error: failed writing ", mirror_txt_file)
-            return False
-    except IOError:
-        print("Warning: Bounding rectangle file does not exist: ", srctxtfile)
-    return True
+            ok = False
+    return ok
+
+def mirrorfile(src, flips, lossless=False):
+    '''make every (fliptag, flipxyz) mirror of the src jpg and its label
+    file.  Runs in a worker process so the messages are returned rather
+    than printed, letting the parent print them in a fixed order'''
+    out = io.StringIO()
+    with redirect_stdout(out):
+        base, ext = os.path.splitext(src)
+        flipimages(src, [(base + tag + ext, flipxyz) for tag, flipxyz in flips], lossless)
+        fliprects(base + ".txt", [(base + tag + ".txt", flipxyz) for tag, flipxyz in flips])
+    return out.getvalue()
+
+def mirrorrecord(dataset, i, flips, lossless=False):
+    '''the (name, jpg, labels, size) mirror records of record i of a
+    packset.PackedDataset, none if it is a mirror itself, and the messages
+    to print.  the image is decoded at most once'''
+    name = dataset.name(i)
+    if dirscan.stem(name)[-3:] in MIRROR_TAGS:
+        return [], ''
+    base, ext = os.path.splitext(name)
+    labels = dataset.labels(i)
+    img = None
+    records = []
+    messages = []
+    for tag, flipxyz in flips:
+        destname = base + tag + ext
+        jpg = flipjpeg_lossless(dataset.jpeg(i), flipxyz) if lossless else None
+        if jpg is not None:
+            messages.append("Mirrored (lossless)  %s  to  %s" % (name, destname))
+        else:
+            if img is None:
+                img = dataset.image(i)
+                if img is None:
+                    messages.append("Failed %s" % name)
+                    break
+            ok, jpg = cv2.imencode('.jpg', cv2.flip(img, flipxyz))
+            if not ok:
+                messages.append("Failed %s" % destname)
+                continue
+            messages.append("Mirrored  %s  to  %s" % (name, destname))
+        records.append((destname, jpg, yololabel.flip(labels, flipxyz), dataset.size(i)))
+    return records, ''.join(m + '\n' for m in messages)
+
+def mirrorpack(prefix, flips, lossless=False, jobs=4):
+    '''rewrite the packset prefix with the flips mirrors of every source
+    record after it, by a pool of jobs threads.  returns the number of
+    records mirrored'''
+    with packset.PackedDataset(prefix) as dataset:
+        # the mirrors that are made again replace the ones already there
+        remade = set()
+        for name in dataset.names:
+            base, ext = os.path.splitext(name)
+            if dirscan.stem(name)[-3:] not in MIRROR_TAGS:
+                remade.update(base + tag + ext for tag, _ in flips)
+        mirrored = 0
+        job = partial(mirrorrecord, dataset, flips=flips, lossless=lossless)
+        with packset.PackWriter(prefix) as writer, \
+                ThreadPoolExecutor(max_workers=max(1, jobs)) as pool:
+            records = makelst.ordered_map(pool, job, range(len(dataset)), 4 * max(1, jobs))
+            for i, (mirrors, messages) in enumerate(records):
+                print(messages, end='')
+                name = dataset.name(i)
+                if name not in remade:
+                    writer.add(name, dataset.jpeg(i), dataset.labels(i), dataset.size(i))
+                for record in mirrors:
+                    writer.add(*record)
+                mirrored += 1 if mirrors else 0
+    return mirrored
 
 #
 #  Main section that plucks and validates the args, and processes the file list
 #
-if len(sys.argv) == 3:
-    # get path to directory to convert
-    path = sys.argv[1]
+def main(argv=None):
+    '''mirror the directory on the command line (or in argv)'''
+    args = parse_args(argv)
+    path = args.directory
 
-    # validate the dir path and scan for jpg files
+    # validate the dir path and scan for jpg files, sorted so the output
+    # does not depend on the directory order
     try:
-        dirlist = fnmatch.filter(os.listdir(path), "*.jpg")
-    except:
-        print("Error:", sys.argv[0], ": exception accessing", sys.argv[1])
+        dirlist = [] if args.pack else \
+            sorted(e.path for e in dirscan.scan(path, recursive=args.recursive))
+        if args.pack and not packset.exists(path):
+            raise OSError(path)
+    except OSError:
+        print("Error:", sys.argv[0], ": exception accessing", path)
         sys.exit()
 
-    # get the axis that we want to mirror the file around
-    fliptag = sys.argv[2].lower()
-    flipxyz = FLIPMAP.get(fliptag)
-    if flipxyz is None:
-        print(sys.argv[0] + " : " + sys.argv[2] +
-              " is not valid direction should be one of x, y, or z ")
-        sys.exit()
+    # get the axes that we want to mirror the files around, fliptag will be
+    # the thing we append to the file basename to form the new file, it
+    # will be one of -xX, -yY, -zZ
+    flips = []
+    for axis in args.axes:
+        axis = axis.lower()
+        flipxyz = FLIPMAP.get(axis)
+        if flipxyz is None:
+            print(sys.argv[0] + " : " + axis +
+                  " is not valid direction should be one of x, y, or z ")
+            sys.exit()
+        if ("-" + axis + axis.upper(), flipxyz) not in flips:
+            flips.append(("-" + axis + axis.upper(), flipxyz))
 
-    # fliptag will be the thing we append to the file basename to form
-    # the new file, it will be one of -xX, -yY, -zZ
-    fliptag = "-" + fliptag + fliptag.upper()
+    if args.lossless and JPEGTRAN is None:
+        print(sys.argv[0], ": jpegtran not found, --lossless falls back to re-encoding")
+
+    if args.pack:
+        flipcounter = mirrorpack(path, flips, args.lossless, args.jobs)
+        print(flipcounter, "records mirrored around", " ".join(a.lower() for a in args.axes))
+        return
+
+    # check that it is an original jpg file, and not a mirror
+    # file (which has the -xX, -yY, -zZ at the end
+    sources = [f for f in dirlist if dirscan.stem(f)[-3:] not in MIRROR_TAGS]
     flipcounter = 0
-    # process eash file in the dirlist
-    for file in dirlist:
-        # form the full path to the source jpg file
-        src = os.path.join(path, file)
-        # check that it is an original jpg file, and not a mirror
-        # file (which has the -xX, -yY, -zZ at the end
-        if src[-7:] not in ["-xX.jpg", "-yY.jpg", "-zZ.jpg"]:
-            # it is a jpg file, so form the path where we are going to
-            # put the mirror file (same directory)
-            dest = src[:-4]+fliptag + ".jpg"
-            # flip the image and store it into the destination path
-            flipimage(src, dest, flipxyz)
-            # now look for the rectangle file associated with the
-            # source jpg file
-            txtfile = src[:-4] + ".txt"
-            mirror_txt_file = dest[:-4] + ".txt"
-            fliprect(txtfile, mirror_txt_file, flipxyz)
+    job = partial(mirrorfile, flips=flips, lossless=args.lossless)
+    with ProcessPoolExecutor(max_workers=max(1, args.jobs)) as pool:
+        for messages in pool.map(job, sources, chunksize=8):
+            print(messages, end='')
             flipcounter += 1
 
-    print(flipcounter, "files mirrored around", sys.argv[2])
+    print(flipcounter, "files mirrored around", " ".join(a.lower() for a in args.axes))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,269 @@
+#!/usr/bin/python
+'''Packed dataset, a directory of jpg + yolo_mark txt files in four files.
+#
+# On a network filesystem opening and stat'ing thousands of small jpg and
+# txt files costs far more than reading them.  A packset holds the same
+# data in a few large files that are memory mapped once:
+#
+#   PREFIX.pack        the JPEG bytes of every image one after another,
+#                      stored as they are (no re-encoding)
+#   PREFIX.index.npy   one INDEX row per image: offset and size of its
+#                      bytes in PREFIX.pack, width and height (as cv2
+#                      loads it), and its rows label_start:label_end in
+#   PREFIX.labels.npy  the (M, 5) float32 yolo_mark labels of all the images
+#                      (ClassID Xcenter Ycenter Xextent Yextent, see yololabel)
+#   PREFIX.names.txt   the path of each image relative to the directory it
+#                      was packed from, one per line
+#
+# Create one from a directory with the same layout makelst.py reads:
+#
+#   python packset.py --imagedir data/train --recursive data/train-pack
+#
+# PackedDataset maps the pack with mmap and the tables with
+# np.load(mmap_mode='r'), records are slices of those maps so nothing is
+# read or copied until it is used, and a JPEG is decoded straight from the
+# page cache:
+#
+#  ds = PackedDataset('data/train-pack')
+#  for i in range(len(ds)):
+#      ds.name(i), ds.size(i)       # sub/img0.jpg (width, height)
+#      ds.jpeg(i)                   # memoryview of the JPEG bytes
+#      ds.labels(i)                 # (N, 5) read only view
+#      ds.image(i)                  # decoded BGR image, ds.image(i, (416, 416))
+#                                   # decodes at a reduced size like imread_scaled
+#
+# PackWriter writes a new packset record by record, it is what resizeimg.py
+# and mirrorxyz.py --pack use to rewrite one.  All the files are written
+# under temp names and renamed into place by close() so readers of an
+# existing packset never see half of one.
+#'''
+import sys
+import os
+import mmap
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import cv2
+import imgio
+import makelst
+import yololabel
+
+INDEX = np.dtype([('offset', '<u8'), ('size', '<u8'), ('width', '<u4'), ('height', '<u4'),
+                  ('label_start', '<u8'), ('label_end', '<u8')])
+SUFFIXES = ('.pack', '.index.npy', '.labels.npy', '.names.txt')
+
+
+def filenames(prefix):
+    '''the (pack, index, labels, names) files of the packset prefix'''
+    return tuple(prefix + suffix for suffix in SUFFIXES)
+
+
+def exists(prefix):
+    '''True if prefix names a complete packset'''
+    return all(os.path.isfile(f) for f in filenames(prefix))
+
+
+def image_size(jpg):
+    '''(width, height) of the image data jpg, None if it can't be decoded'''
+    hdr = imgio.jpeg_header_bytes(jpg)
+    if hdr is not None:
+        return (hdr.width, hdr.height)
+    img = cv2.imdecode(np.frombuffer(jpg, dtype=np.uint8), cv2.IMREAD_COLOR)
+    if img is None:
+        return None
+    return (img.shape[1], img.shape[0])
+
+
+class PackWriter:
+    '''Write a packset record by record'''
+    def __init__(self, prefix):
+        self.prefix = prefix
+        self._tmpnames = [f + '.tmp' for f in filenames(prefix)]
+        self._pack = open(self._tmpnames[0], 'wb')
+        self._rows = []
+        self._labels = []
+        self._names = []
+        self._offset = 0
+        self._nlabels = 0
+
+    def __len__(self):
+        return len(self._rows)
+
+    def add(self, name, jpg, labels=None, size=None):
+        '''append the image data jpg (bytes or a memoryview) with its (N, 5)
+        labels as name.  size is its (width, height) if the caller knows it.
+        returns False if jpg is not an image'''
+        if size is None:
+            size = image_size(jpg)
+            if size is None:
+                return False
+        if '\n' in name:
+            raise ValueError('packset names can not contain a newline: %r' % name)
+        nlabels = 0 if labels is None else len(labels)
+        self._pack.write(jpg)
+        self._rows.append((self._offset, len(jpg), size[0], size[1],
+                           self._nlabels, self._nlabels + nlabels))
+        if nlabels:
+            self._labels.append(np.asarray(labels, dtype=np.float32).reshape(-1, 5))
+        self._names.append(name)
+        self._offset += len(jpg)
+        self._nlabels += nlabels
+        return True
+
+    def close(self):
+        '''write the tables and rename everything into place'''
+        self._pack.close()
+        labels = np.concatenate(self._labels) if self._labels else yololabel.empty()
+        with open(self._tmpnames[1], 'wb') as f:
+            np.save(f, np.array(self._rows, dtype=INDEX))
+        with open(self._tmpnames[2], 'wb') as f:
+            np.save(f, labels)
+        with open(self._tmpnames[3], 'w') as f:
+            f.writelines(name + '\n' for name in self._names)
+        for tmpname, name in zip(self._tmpnames, filenames(self.prefix)):
+            os.replace(tmpname, name)
+
+    def abort(self):
+        '''throw away what has been written'''
+        self._pack.close()
+        for tmpname in self._tmpnames:
+            if os.path.exists(tmpname):
+                os.remove(tmpname)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, *exc):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+        return False
+
+
+class PackedDataset:
+    '''Read only memory mapped view of a packset'''
+    def __init__(self, prefix):
+        self.prefix = prefix
+        packfile, indexfile, labelsfile, namesfile = filenames(prefix)
+        self.index = np.load(indexfile, mmap_mode='r')
+        self.label_table = np.load(labelsfile, mmap_mode='r')
+        with open(namesfile, 'r') as f:
+            self.names = f.read().splitlines()
+        if len(self.names) != len(self.index):
+            raise ValueError('%s: %d names for %d records' %
+                             (prefix, len(self.names), len(self.index)))
+        self._positions = None
+        self._mmap = None
+        self._data = memoryview(b'')
+        if os.path.getsize(packfile):
+            # mmap can't map an empty file
+            with open(packfile, 'rb') as f:
+                self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            self._data = memoryview(self._mmap)
+
+    def __len__(self):
+        return len(self.index)
+
+    def __iter__(self):
+        '''(name, labels, jpeg) of every record in order'''
+        for i in range(len(self)):
+            yield self.names[i], self.labels(i), self.jpeg(i)
+
+    def name(self, i):
+        '''the name of record i'''
+        return self.names[i]
+
+    def position(self, name):
+        '''the record number of name, KeyError if it is not in the packset'''
+        if self._positions is None:
+            self._positions = {n: i for i, n in enumerate(self.names)}
+        return self._positions[name]
+
+    def size(self, i):
+        '''(width, height) of the image of record i'''
+        row = self.index[i]
+        return (int(row['width']), int(row['height']))
+
+    def jpeg(self, i):
+        '''memoryview of the JPEG bytes of record i in the mapped pack'''
+        row = self.index[i]
+        offset = int(row['offset'])
+        return self._data[offset:offset + int(row['size'])]
+
+    def labels(self, i):
+        '''(N, 5) read only view of the labels of record i'''
+        row = self.index[i]
+        return self.label_table[int(row['label_start']):int(row['label_end'])]
+
+    def image(self, i, dim=None):
+        '''the decoded BGR image of record i, resized to dim (width, height)
+        if given.  None if it can't be decoded'''
+        if dim is not None:
+            return imgio.imdecode_scaled(self.jpeg(i), dim)
+        return cv2.imdecode(np.frombuffer(self.jpeg(i), dtype=np.uint8), cv2.IMREAD_COLOR)
+
+    def close(self):
+        '''drop the maps, the pack is unmapped once the last jpeg() view the
+        caller still holds is gone'''
+        self._data = memoryview(b'')
+        self._mmap = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+        return False
+
+
+def read_entry(entry):
+    '''(name, labels, bytes) of a makelst.scan_entries entry, bytes is None
+    if the jpg can't be read'''
+    _, name, labels, read = entry
+    try:
+        return name, labels, read()
+    except OSError:
+        return name, labels, None
+
+
+def pack_dir(imagedir, prefix, recursive=False, jobs=4):
+    '''pack the jpg files and yolo_mark labels of imagedir (sorted by name)
+    into the packset prefix, files are read by a pool of jobs threads.
+    returns the number of records written'''
+    entries = sorted(makelst.scan_entries(imagedir, recursive), key=lambda e: e[1])
+    with PackWriter(prefix) as writer, ThreadPoolExecutor(max_workers=max(1, jobs)) as pool:
+        for name, labels, jpg in makelst.ordered_map(pool, read_entry, entries,
+                                                     4 * max(1, jobs)):
+            if jpg is None or not writer.add(name, jpg, labels):
+                print(sys.argv[0], ": skipping", name, "not a readable image", file=sys.stderr)
+    return len(writer)
+
+
+def parse_args(argv=None):
+    '''Process command line'''
+    parser = argparse.ArgumentParser(
+        description='pack a directory of jpg and yolo_mark txt files into a memory '
+                    'mapped packset that detectimg.py, resizeimg.py and mirrorxyz.py '
+                    'can read without opening each file')
+    parser.add_argument('--imagedir', dest='imagedir', required=True,
+                        help='directory of jpg/txt files to pack')
+    parser.add_argument('--recursive', dest='recursive', action='store_true',
+                        help='also pack files in subdirectories')
+    parser.add_argument('--jobs', dest='jobs', type=int, default=4,
+                        help='number of threads reading files; default=4')
+    parser.add_argument('prefix', help='packset to write, PREFIX.pack, PREFIX.index.npy ...')
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    '''pack the directory the command line (or argv) specifies'''
+    args = parse_args(argv)
+    if not os.path.isdir(args.imagedir):
+        print(sys.argv[0], ": exception accessing", args.imagedir, file=sys.stderr)
+        sys.exit()
+    count = pack_dir(args.imagedir, args.prefix, args.recursive, args.jobs)
+    print(sys.argv[0], ": packed", count, "images into", args.prefix, file=sys.stderr)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,170 @@
+'''Vectorized postprocessing of batched detection outputs.
+#
+# The network returns a (batch, boxes, 6) array per forward pass, each row
+#   ClassID  score  xmin  ymin  xmax  ymax
+# with normalized coordinates and ClassID -1 for empty rows.  detections()
+# turns a whole batch into one compact structured array in a handful of
+# numpy operations instead of a Python loop per row:
+#   - rows below the score threshold (and empty rows) are dropped
+#   - optional class aware non maximum suppression, boxes of different
+#     images or classes never suppress each other.  The greedy suppression
+#     of each image/class group is computed with whole matrix passes, one
+#     per link of the longest chain of boxes suppressing each other (a few)
+#     rather than one Python step per kept box
+#   - optional per class top k and per image top n
+# The result is sorted by image then descending score, so the detections
+# of image i are the slice of rows where det['image'] == i (see split()).
+#
+#  det = detections(prob, count=3, flt=Filter(thresh=0.5, topk=10, nms=0.45))
+#  det['image'], det['label'], det['score'], det['bbox']   # bbox is (N, 4)
+#  for labels, scores, bbox in split(det, 3): ...
+#'''
+from collections import namedtuple
+import numpy as np
+
+# the boxes kept of each image: the nbbox best (0 keeps all) scoring at
+# least thresh, of the topk best of each class (0 keeps all) after NMS
+# suppressing boxes that overlap more than nms (0 disables it)
+Filter = namedtuple('Filter', ['nbbox', 'thresh', 'topk', 'nms'], defaults=(0, 0.0, 0, 0.0))
+# groups of more boxes than this are suppressed one box at a time, the
+# matrix passes need memory for the square of the group size
+NMS_MATRIX_MAX = 4096
+
+DETECTION = np.dtype([('image', np.int32), ('label', np.int32),
+                      ('score', np.float32), ('bbox', np.float32, (4,))])
+
+
+def empty():
+    '''a structured array with no detections'''
+    return np.zeros(0, dtype=DETECTION)
+
+
+def iou(box, boxes):
+    '''intersection over union of box with each of the (N, 4) boxes'''
+    x1 = np.maximum(box[0], boxes[:, 0])
+    y1 = np.maximum(box[1], boxes[:, 1])
+    x2 = np.minimum(box[2], boxes[:, 2])
+    y2 = np.minimum(box[3], boxes[:, 3])
+    inter = np.clip(x2 - x1, 0, None) * np.clip(y2 - y1, 0, None)
+    area = (box[2] - box[0]) * (box[3] - box[1])
+    areas = (boxes[:, 2] - boxes[:, 0]) * (boxes[:, 3] - boxes[:, 1])
+    return inter / np.maximum(area + areas - inter, 1e-12)
+
+
+def pairwise_iou(boxes):
+    '''the (N, N) intersection over union of every pair of the (N, 4) boxes'''
+    lo = np.maximum(boxes[:, np.newaxis, :2], boxes[np.newaxis, :, :2])
+    hi = np.minimum(boxes[:, np.newaxis, 2:], boxes[np.newaxis, :, 2:])
+    inter = np.prod(np.clip(hi - lo, 0, None), axis=2)
+    areas = (boxes[:, 2] - boxes[:, 0]) * (boxes[:, 3] - boxes[:, 1])
+    return inter / np.maximum(areas[:, np.newaxis] + areas[np.newaxis, :] - inter, 1e-12)
+
+
+def greedy_keep(boxes, overlap):
+    '''mask of the (N, 4) boxes, sorted by descending score, kept by greedy
+    non maximum suppression.  a box is kept if no kept higher scoring box
+    overlaps it by more than overlap, starting from all kept and repeating
+    that until nothing changes gives the greedy result (a box is settled
+    once every box above it is) in as many passes as the longest chain of
+    boxes suppressing each other'''
+    if len(boxes) > NMS_MATRIX_MAX:
+        keep = np.zeros(len(boxes), dtype=bool)
+        order = np.arange(len(boxes))
+        while order.size:
+            keep[order[0]] = True
+            order = order[1:][iou(boxes[order[0]], boxes[order[1:]]) <= overlap]
+        return keep
+    # suppresses[i, j]: box i scores higher than box j and overlaps it
+    suppresses = np.triu(pairwise_iou(boxes) > overlap, k=1)
+    keep = np.ones(len(boxes), dtype=bool)
+    while True:
+        kept = ~suppresses[keep].any(axis=0)
+        if np.array_equal(kept, keep):
+            return keep
+        keep = kept
+
+
+def nms(boxes, scores, group_ids, overlap):
+    '''indexes of the boxes kept by greedy non maximum suppression in
+    descending score order, a box is dropped if it overlaps a higher scoring
+    box of the same group by more than overlap'''
+    if not len(boxes):
+        return np.zeros(0, dtype=np.int64)
+    # by group, descending score within a group (ties in index order)
+    order = np.lexsort((-scores, group_ids))
+    bounds = np.r_[0, np.flatnonzero(np.diff(group_ids[order])) + 1, len(order)]
+    keep = np.concatenate([order[lo:hi][greedy_keep(boxes[order[lo:hi]], overlap)]
+                           for lo, hi in zip(bounds[:-1], bounds[1:])])
+    keep.sort()
+    return keep[np.argsort(-scores[keep], kind='stable')]
+
+
+def rank_within(keys):
+    '''for a sorted key array, the position of each element among the
+    elements with the same key (0 for the first of each run)'''
+    if not len(keys):
+        return np.zeros(0, dtype=np.int64)
+    index = np.arange(len(keys))
+    starts = np.r_[0, np.flatnonzero(keys[1:] != keys[:-1]) + 1]
+    return index - np.repeat(starts, np.diff(np.r_[starts, len(keys)]))
+
+
+def from_outputs(prob, count=None, thresh=0.0):
+    '''the rows of the first count images of the (batch, boxes, 6) network
+    output prob scoring at least thresh, as an unsorted DETECTION array'''
+    prob = np.asarray(prob)[:count]
+    boxes = prob.shape[1]
+    rows = prob.reshape(-1, prob.shape[-1])
+    keep = np.flatnonzero((rows[:, 0] >= 0) & (rows[:, 1] >= thresh))
+    det = np.empty(len(keep), dtype=DETECTION)
+    det['image'] = keep // boxes
+    det['label'] = rows[keep, 0]
+    det['score'] = rows[keep, 1]
+    det['bbox'] = rows[keep, 2:6]
+    return det
+
+
+def groups(det):
+    '''an id for the (image, class) pair of each detection'''
+    return det['image'].astype(np.int64) * (int(det['label'].max(initial=0)) + 1) + det['label']
+
+
+def suppress(det, overlap):
+    '''class aware non maximum suppression of a DETECTION array'''
+    return det[nms(det['bbox'], det['score'], groups(det), overlap)]
+
+
+def limit(det, topk=0, nmax=0):
+    '''det sorted by image and descending score, topk > 0 keeps the best
+    topk boxes of each class of an image and nmax > 0 the best nmax boxes
+    of each image'''
+    if topk > 0:
+        keys = groups(det)
+        order = np.lexsort((-det['score'], keys))
+        det = det[order][rank_within(keys[order]) < topk]
+    det = det[np.lexsort((-det['score'], det['image']))]
+    if nmax > 0:
+        det = det[rank_within(det['image']) < nmax]
+    return det
+
+
+def detections(prob, count=None, flt=Filter()):
+    '''the detections of the first count images of the (batch, boxes, 6)
+    network output prob as a DETECTION structured array sorted by image and
+    descending score, the boxes of each image the Filter flt keeps'''
+    det = from_outputs(prob, count, flt.thresh)
+    if flt.nms > 0:
+        det = suppress(det, flt.nms)
+    return limit(det, flt.topk, flt.nbbox)
+
+
+def split(det, count):
+    '''per image (labels, scores, bbox) views into det for images 0..count-1,
+    labels and scores are (N, 1) and bbox (N, 4) like detectimg.predict'''
+    bounds = np.searchsorted(det['image'], np.arange(count + 1))
+    results = []
+    for lo, hi in zip(bounds[:-1], bounds[1:]):
+        part = det[lo:hi]
+        results.append((part['label'].reshape(-1, 1), part['score'].reshape(-1, 1),
+                        part['bbox']))
+    return results
@@ -5,61 +5,243 @@
 
    python resizeimg.py --width 800 image-dir1 image-dir2 image-dir3...
 
-   resized images will be overwritten'''
+   resized images will be overwritten, .jpg and .jpeg files of any case
+   are resized, --recursive takes in subdirectories too
+
+   files are spread over a pool of --jobs processes.  only the JPEG header
+   is read to find images that are already narrow enough, and a small
+   manifest (.resizeimg.json) is kept in each directory so a rerun only
+   looks at new or changed files.  resized images are written to a temp
+   file and renamed over the original so an interrupted run never leaves
+   a truncated JPEG behind.
+
+   python resizeimg.py --width 800 --pack data/train-pack
+
+   with --pack the arguments are packsets (see packset.py) which are
+   rewritten with the wide images resized, the others are copied over as
+   they are.  the index holds every image size so a packset with nothing
+   to resize is left alone without reading any of it.'''
 import sys
-import fnmatch
 import os
+import json
 import argparse
+from functools import partial
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+import numpy as np
 import cv2
+import dirscan
+import imgio
+import makelst
+import packset
 
-def parse_args():
+MANIFEST = '.resizeimg.json'
+# save the manifest every this many files so a killed run keeps most of its work
+MANIFEST_SAVE_EVERY = 1000
+# files handed to the pool ahead of the one being collected, so the scan
+# of a huge directory doesn't queue every file before resizing starts
+RESIZE_WINDOW = 256
+
+def parse_args(argv=None):
     '''Process command line'''
     description = '''resize images in specified folders such that if thier width
 is > --width it will reduced to width preserving aspect ratio'''
     parser = argparse.ArgumentParser(description, usage="resizeimg.py --width 250 dir1 dir2...")
     parser.add_argument('--width', dest='width', required=True, type=int,
                         help='width in pixels to clamp image size to')
+    parser.add_argument('--jobs', dest='jobs', type=int, default=os.cpu_count(),
+                        help='number of processes resizing files; default number of cpus')
+    parser.add_argument('--force', dest='force', action='store_true',
+                        help='ignore the manifest and look at every file again')
+    parser.add_argument('--recursive', dest='recursive', action='store_true',
+                        help='also resize files in subdirectories')
+    parser.add_argument('--pack', dest='pack', action='store_true',
+                        help='the arguments are packsets to rewrite, not directories')
     parser.add_argument('args', nargs=argparse.REMAINDER,
                         help='list of one or more directories to resize files')
-    return parser.parse_args()
+    return parser.parse_args(argv)
+
+def write_atomic(filename, img):
+    '''encode img as a JPEG into a temp file next to filename and rename it
+    over filename, returns False if encoding or writing failed'''
+    ok, buf = cv2.imencode('.jpg', img)
+    if not ok:
+        return False
+    tmpname = filename + '.tmp'
+    try:
+        with open(tmpname, 'wb') as f:
+            f.write(buf.tobytes())
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmpname, filename)
+    except OSError:
+        if os.path.exists(tmpname):
+            os.remove(tmpname)
+        return False
+    return True
 
 def fixsize(filename, width):
     '''Clamp the width of the image to that specified preserving the aspect ratio'''
-    img = cv2.imread(filename)
-    (h, w) = img.shape[:2]
+    hdr = imgio.jpeg_header(filename)
+    if hdr is None:
+        # not a JPEG header we can parse, let cv2 work it out
+        img = cv2.imread(filename)
+        if img is None:
+            print("failed reading:", filename, file=sys.stderr)
+            return None
+        (h, w) = img.shape[:2]
+    else:
+        (w, h) = (hdr.width, hdr.height)
 
     # Rationalize the image sizes
     if w > width:
         r = width / float(w)
         dim = (width, int(h * r))
-        img = cv2.resize(img, dim)
+        if hdr is None:
+            img = cv2.resize(img, dim)
+        else:
+            # decode straight to (close to) the new size
+            img = imgio.imread_scaled(filename, dim, hdr)
+            if img is None:
+                print("failed reading:", filename, file=sys.stderr)
+                return None
         print("resized:", filename, "from", (w, h), "to", dim, file=sys.stderr)
-        if not cv2.imwrite(filename, img):
+        if not write_atomic(filename, img):
             print("failed writing:", filename, file=sys.stderr)
             return None
     else:
+        # already narrow enough, no need to decode it
         print("No change", filename, (w, h), file=sys.stderr)
         dim = (w, h)
 
     return dim
 
-ARGS = parse_args()
-if not ARGS.args:
-    print(sys.argv[0] + ": no directory specified", file=sys.stderr)
-    sys.exit()
+def fixsize_entry(filename, width):
+    '''run fixsize in a worker process, returns (filename, manifest entry)
+    the entry is None if the file could not be processed'''
+    dim = fixsize(filename, width)
+    if dim is None:
+        return filename, None
+    st = os.stat(filename)
+    return filename, [st.st_size, st.st_mtime_ns, dim[0], dim[1]]
 
-if ARGS.width > 2000:
-    print("--width should be less than 2000", file=sys.stderr)
-    sys.exit()
+def load_manifest(fdir):
+    '''load the {relative path: [size, mtime_ns, width, height]} manifest of fdir'''
+    try:
+        with open(os.path.join(fdir, MANIFEST), 'r') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
 
-for fdir in ARGS.args:
+def save_manifest(fdir, manifest):
+    '''write the manifest of fdir, atomically so it is never half written'''
+    fname = os.path.join(fdir, MANIFEST)
     try:
-        files = [os.path.join(fdir, x) for x in fnmatch.filter(os.listdir(fdir), '*.jpg')]
-    except:
-        print (sys.argv[0]+": can't access ", fdir, file=sys.stderr)
-        continue
-    if not files:
+        with open(fname + '.tmp', 'w') as f:
+            json.dump(manifest, f)
+        os.replace(fname + '.tmp', fname)
+    except OSError:
+        print("failed writing:", fname, file=sys.stderr)
+
+def is_current(entry, scanned, width):
+    '''True if the manifest entry says the dirscan entry scanned is unchanged
+    since it was last processed and was left no wider than width'''
+    return (entry is not None and entry[0] == scanned.size and entry[1] == scanned.mtime_ns
+            and entry[2] <= width)
+
+def resizedir(fdir, width, pool, force=False, recursive=False):
+    '''resize all the jpg files in fdir (and below if recursive) that the
+    manifest does not already show as done, using pool.  files are handed
+    to the pool as the directory is scanned, at most RESIZE_WINDOW ahead of
+    the results'''
+    manifest = {} if force else load_manifest(fdir)
+    scanned = [0]
+
+    def todo():
+        for entry in dirscan.scan(fdir, recursive=recursive):
+            scanned[0] += 1
+            if not is_current(manifest.get(entry.relpath), entry, width):
+                yield entry.path
+
+    done = 0
+    job = partial(fixsize_entry, width=width)
+    for filename, entry in makelst.ordered_map(pool, job, todo(), RESIZE_WINDOW):
+        name = os.path.relpath(filename, fdir)
+        if entry is None:
+            manifest.pop(name, None)
+        else:
+            manifest[name] = entry
+        done += 1
+        if done % MANIFEST_SAVE_EVERY == 0:
+            save_manifest(fdir, manifest)
+    if not scanned[0]:
         print("skipping: no jpg files in", fdir, file=sys.stderr)
-        continue
-    for f in files:
-        fixsize(f, ARGS.width)
+        return 0
+    save_manifest(fdir, manifest)
+    print(fdir, ":", done, "new or changed of", scanned[0], "jpg files", file=sys.stderr)
+    return done
+
+def fixsize_record(dataset, i, width):
+    '''fixsize for record i of a packset.PackedDataset, returns the (jpg,
+    (width, height)) to write for it.  jpg is the record's own bytes if it is
+    narrow enough or can't be resized'''
+    name = dataset.name(i)
+    (w, h) = dataset.size(i)
+    if w <= width:
+        print("No change", name, (w, h), file=sys.stderr)
+        return dataset.jpeg(i), (w, h)
+    dim = (width, int(h * width / float(w)))
+    img = dataset.image(i, dim)
+    if img is None:
+        print("failed reading:", name, file=sys.stderr)
+        return dataset.jpeg(i), (w, h)
+    ok, buf = cv2.imencode('.jpg', img)
+    if not ok:
+        print("failed writing:", name, file=sys.stderr)
+        return dataset.jpeg(i), (w, h)
+    print("resized:", name, "from", (w, h), "to", dim, file=sys.stderr)
+    return buf, dim
+
+def resizepack(prefix, width, jobs):
+    '''rewrite the packset prefix with the images wider than width resized,
+    by a pool of jobs threads (cv2 releases the GIL while it decodes and
+    encodes).  returns the number of images resized'''
+    with packset.PackedDataset(prefix) as dataset:
+        todo = int(np.count_nonzero(dataset.index['width'] > width))
+        if todo:
+            job = partial(fixsize_record, dataset, width=width)
+            with packset.PackWriter(prefix) as writer, \
+                    ThreadPoolExecutor(max_workers=max(1, jobs)) as pool:
+                records = makelst.ordered_map(pool, job, range(len(dataset)), 4 * max(1, jobs))
+                for i, (jpg, size) in enumerate(records):
+                    writer.add(dataset.name(i), jpg, dataset.labels(i), size)
+    print(prefix, ":", todo, "resized of", len(dataset), "images", file=sys.stderr)
+    return todo
+
+def main(argv=None):
+    '''resize the directories on the command line (or in argv)'''
+    args = parse_args(argv)
+    if not args.args:
+        print(sys.argv[0] + ": no directory specified", file=sys.stderr)
+        sys.exit()
+
+    if args.width > 2000:
+        print("--width should be less than 2000", file=sys.stderr)
+        sys.exit()
+
+    if args.pack:
+        for prefix in args.args:
+            if not packset.exists(prefix):
+                print(sys.argv[0]+": can't access packset", prefix, file=sys.stderr)
+                continue
+            resizepack(prefix, args.width, args.jobs)
+        return
+
+    with ProcessPoolExecutor(max_workers=max(1, args.jobs)) as pool:
+        for fdir in args.args:
+            if not os.path.isdir(fdir):
+                print(sys.argv[0]+": can't access ", fdir, file=sys.stderr)
+                continue
+            resizedir(fdir, args.width, pool, args.force, args.recursive)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,84 @@
+'''Split large images into overlapping network sized tiles.
+#
+# Squashing a 4K frame down to a 416x416 network input loses small
+# objects.  Instead the full resolution image is covered by overlapping
+# tile x tile windows, every window goes through the network at its
+# native input size, and the boxes found in each tile are mapped back to
+# normalized coordinates of the whole image.  Objects cut by a tile edge
+# are seen whole in the neighbouring tile thanks to the overlap, and the
+# duplicates are merged with class aware NMS (postprocess.suppress).
+#
+# The tiles are numpy views into the decoded image, nothing is copied
+# until they are written into the batch array for the network.
+#
+#  img = cv2.imread('big.jpg')
+#  origins = tile_origins(img.shape, 416, overlap=0.2)
+#  batch = tile_batch(img, origins, 416)      # (len(origins), 3, 416, 416)
+#  ... run the batch through the network ...
+#  det = merge(postprocess.from_outputs(prob), origins, 416, img.shape)
+#'''
+import numpy as np
+import cv2
+import postprocess
+
+# IoU above which boxes of the same class from different tiles are merged
+MERGE_OVERLAP = 0.5
+
+
+def axis_origins(length, tile, overlap):
+    '''start positions of tiles covering 0..length, neighbouring tiles
+    share at least overlap of the tile size and the last one ends at length'''
+    if length <= tile:
+        return [0]
+    step = max(1, int(tile * (1.0 - overlap)))
+    count = -(-(length - tile) // step) + 1
+    # spread the tiles evenly so the last one ends exactly at the edge
+    return [round(i * (length - tile) / (count - 1)) for i in range(count)]
+
+
+def tile_origins(shape, tile, overlap=0.2):
+    '''the (x, y) top left corners of the tiles covering an image of shape'''
+    h, w = shape[:2]
+    return [(x, y) for y in axis_origins(h, tile, overlap)
+            for x in axis_origins(w, tile, overlap)]
+
+
+def tiles(img, origins, tile):
+    '''the tile views of img, smaller than tile x tile where the image is'''
+    return [img[y:y + tile, x:x + tile] for x, y in origins]
+
+
+def tile_batch(img, origins, tile, out=None):
+    '''write the tiles of a BGR image into a (len(origins), 3, tile, tile)
+    float32 RGB batch (out if given).  tiles of an image smaller than the
+    tile are stretched to fill it'''
+    if out is None:
+        out = np.empty((len(origins), 3, tile, tile), dtype=np.float32)
+    for i, view in enumerate(tiles(img, origins, tile)):
+        if view.shape[:2] != (tile, tile):
+            view = cv2.resize(view, (tile, tile))
+        # BGR HWC to RGB CHW as a view, the only copy is into the batch
+        out[i] = view[:, :, ::-1].transpose(2, 0, 1)
+    return out
+
+
+def merge(det, origins, tile, shape, overlap=MERGE_OVERLAP):
+    '''map the DETECTION array of a batch of tiles (image is the tile index)
+    to normalized coordinates of the whole image of shape, and suppress
+    boxes of the same class overlapping by more than overlap (duplicates
+    found in overlapping tiles, or anything else), 0 for none.  returns the
+    detections as image 0, sorted by descending score'''
+    h, w = shape[:2]
+    origins = np.asarray(origins, dtype=np.float32).reshape(-1, 2)
+    index = det['image']
+    # the pixel size of each tile, smaller than tile along a short image axis
+    tw = np.minimum(tile, w - origins[index, 0])
+    th = np.minimum(tile, h - origins[index, 1])
+    det = det.copy()
+    bbox = det['bbox']
+    bbox[:, [0, 2]] = (origins[index, 0, np.newaxis] + bbox[:, [0, 2]] * tw[:, np.newaxis]) / w
+    bbox[:, [1, 3]] = (origins[index, 1, np.newaxis] + bbox[:, [1, 3]] * th[:, np.newaxis]) / h
+    det['image'] = 0
+    if overlap > 0:
+        det = postprocess.suppress(det, overlap)
+    return postprocess.limit(det)
@@ -0,0 +1,118 @@
+'''Read frames from a video file or capture device on a background thread.
+#
+# A FrameReader decodes frames with cv2.VideoCapture on its own thread so
+# decoding overlaps with whatever the caller does with the previous frame
+# (running detection on it).
+#
+#  source    a video file name, or a capture device number (0, 1 ...),
+#            a string of digits is taken as a device number
+#  stride    default=1, only every stride'th frame is decoded, the others
+#            are skipped with grab() which does not decode them
+#  realtime  default=True, hold the real time rate: read() returns the
+#            newest frame and any older one the caller did not get to is
+#            dropped.  A video file is paced at its own frame rate as if
+#            it was a live camera.  With realtime=False every frame is
+#            returned (a slow caller slows the reader down)
+#
+#  reader = FrameReader('test.mp4')
+#  while True:
+#      frame = reader.read()       # (index, capture time, image) or None
+#      if frame is None:           # at the end of the video
+#          break
+#      ...
+#  reader.close()
+#
+#  frames_read and frames_dropped count the decoded frames and the ones
+#  read() never returned, fps is the source frame rate (0 if unknown).
+#'''
+import time
+import threading
+from collections import deque
+import cv2
+
+
+class FrameReader:
+    '''Background thread decoding frames from a cv2.VideoCapture source'''
+    def __init__(self, source, stride=1, realtime=True, queue_size=4):
+        if isinstance(source, str) and source.isdigit():
+            source = int(source)
+        self.source = source
+        self.live = isinstance(source, int)
+        self.stride = max(1, stride)
+        self.realtime = realtime
+        self.capture = cv2.VideoCapture(source)
+        if not self.capture.isOpened():
+            raise IOError("can't open video source %s" % source)
+        self.fps = self.capture.get(cv2.CAP_PROP_FPS) or 0
+        self.frames_read = 0
+        self.frames_dropped = 0
+        self._frames = deque()
+        self._queue_size = 1 if realtime else max(1, queue_size)
+        self._done = False
+        self._cond = threading.Condition()
+        self._thread = threading.Thread(target=self.__reader_loop, daemon=True)
+        self._thread.start()
+
+    def read(self):
+        '''the next (index, capture time, image) frame, waits for one to be
+        decoded.  None once the source has no more frames'''
+        with self._cond:
+            while not self._frames and not self._done:
+                self._cond.wait()
+            if not self._frames:
+                return None
+            frame = self._frames.popleft()
+            self._cond.notify_all()
+            return frame
+
+    def close(self):
+        '''stop the reader thread and release the capture'''
+        with self._cond:
+            self._done = True
+            self._frames.clear()
+            self._cond.notify_all()
+        self._thread.join()
+        self.capture.release()
+
+    def __put(self, frame):
+        '''hand a decoded frame to read(), in realtime mode it replaces a
+        frame still waiting, otherwise it waits for room'''
+        with self._cond:
+            if self.realtime:
+                self.frames_dropped += len(self._frames)
+                self._frames.clear()
+            while len(self._frames) >= self._queue_size and not self._done:
+                self._cond.wait()
+            if self._done:
+                return False
+            self._frames.append(frame)
+            self._cond.notify_all()
+            return True
+
+    def __reader_loop(self):
+        '''decode frames until the source ends or close() is called'''
+        start = time.time()
+        index = -1
+        try:
+            while not self._done:
+                index += 1
+                if index % self.stride:
+                    # skipped frames are not decoded
+                    if not self.capture.grab():
+                        break
+                    continue
+                if self.realtime and not self.live and self.fps > 0:
+                    # play the file at its own frame rate
+                    delay = start + index / self.fps - time.time()
+                    if delay > 0:
+                        time.sleep(delay)
+                ok, img = self.capture.read()
+                if not ok:
+                    break
+                self.frames_read += 1
+                if not self.__put((index, time.time(), img)):
+                    break
+        finally:
+            with self._cond:
+                self._done = True
+                self._cond.notify_all()
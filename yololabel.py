@@ -0,0 +1,102 @@
+'''Load, transform and save yolo_mark label files as numpy arrays.
+#
+# A yolo_mark label file has the same basename as its jpg, one object per
+# line:   ClassID  Xcenter  Ycenter  Xextent  Yextent
+# with the coordinates normalized to 0..1.  Lines without exactly 5 fields
+# are ignored.
+#
+# Labels are held as compact (N, 5) float32 arrays with the same columns,
+# so the transforms below work on every box of a file (or a whole
+# directory) at once instead of line by line.  float32 rounds the text
+# values, pass dtype=np.float64 where they have to come out exactly as
+# written (makelst's LST lines).
+#
+#  labels = load('data/img0.txt')         # None if there is no label file
+#  boxes = to_corners(labels)             # ClassID xmin ymin xmax ymax
+#  save('data/img0-yY.txt', flip(labels, 1))
+#
+#  labels, offsets = load_all(txtfiles)   # labels of txtfiles[i] are
+#                                         # labels[offsets[i]:offsets[i+1]]
+#'''
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+
+# column indexes of a label row
+CLASSID, XCENTER, YCENTER, XEXTENT, YEXTENT = range(5)
+
+
+def empty(dtype=np.float32):
+    '''an array with no labels'''
+    return np.zeros((0, 5), dtype=dtype)
+
+
+def parse(text, dtype=np.float32):
+    '''parse the text of a label file into an (N, 5) float32 (or dtype) array'''
+    rows = [l.split() for l in text.splitlines()]
+    rows = [r for r in rows if len(r) == 5]
+    if not rows:
+        return empty(dtype)
+    # numpy converts all the strings in one go
+    return np.array(rows, dtype=dtype)
+
+
+def load(txtfile, dtype=np.float32):
+    '''load txtfile into an (N, 5) float32 (or dtype) array, None if it can't
+    be read'''
+    try:
+        with open(txtfile, 'r') as f:
+            return parse(f.read(), dtype)
+    except (IOError, ValueError):
+        return None
+
+
+def load_all(txtfiles, workers=8, dtype=np.float32):
+    '''load many label files at once using a pool of reader threads.
+    returns (labels, offsets), labels is the (M, 5) concatenation of every
+    file and the labels of txtfiles[i] are labels[offsets[i]:offsets[i+1]],
+    files that are missing have no rows'''
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as pool:
+        arrays = [a if a is not None else empty(dtype)
+                  for a in pool.map(lambda f: load(f, dtype), txtfiles)]
+    offsets = np.zeros(len(arrays) + 1, dtype=np.int64)
+    np.cumsum([len(a) for a in arrays], out=offsets[1:])
+    if not arrays:
+        return empty(dtype), offsets
+    return np.concatenate(arrays), offsets
+
+
+def to_corners(labels):
+    '''convert center/extent labels to ClassID xmin ymin xmax ymax rows'''
+    corners = np.empty_like(labels)
+    corners[:, 0] = labels[:, CLASSID]
+    half = labels[:, [XEXTENT, YEXTENT]] / 2
+    corners[:, 1:3] = labels[:, [XCENTER, YCENTER]] - half
+    corners[:, 3:5] = labels[:, [XCENTER, YCENTER]] + half
+    return corners
+
+
+def flip(labels, flipxyz):
+    '''return a copy of labels matching an image mirrored with
+    cv2.flip(img, flipxyz): 0 top/bottom, 1 left/right, -1 both'''
+    flipped = labels.copy()
+    if flipxyz in [-1, 0]:
+        flipped[:, YCENTER] = 1.0 - flipped[:, YCENTER]
+    if flipxyz in [-1, 1]:
+        flipped[:, XCENTER] = 1.0 - flipped[:, XCENTER]
+    return flipped
+
+
+def format_labels(labels):
+    '''the text of a label file holding labels'''
+    return ''.join('%d %.6f %.6f %.6f %.6f\n' % (int(r[0]), r[1], r[2], r[3], r[4])
+                   for r in labels.tolist())
+
+
+def save(txtfile, labels):
+    '''write labels to txtfile in the yolo_mark format, False if it fails'''
+    try:
+        with open(txtfile, 'w') as f:
+            f.write(format_labels(labels))
+    except IOError:
+        return False
+    return True